@@ -0,0 +1,259 @@
+'''Benchmarks the filters over image size, patch size, search distance and batch size.
+
+Examples:
+    python benchmark.py --output bench.json
+    python benchmark.py --filters nlm wnnm --sizes 64 128 --output new.json --compare bench.json
+    python benchmark.py --dtypes float64 float32 --output dtypes.json
+'''
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from itertools import product
+
+import numpy as np
+
+from utilities.utils import read_image, add_gaussian_noise, normalize_image, PSNR
+
+
+FILTERS = ['quad', 'TV', 'TV_pd', 'nlm', 'wnnm']
+PATCH_FILTERS = ['nlm', 'wnnm']
+
+
+def get_filter(name):
+    '''Returns a function that runs one of the filters with the experiment settings.
+
+    Args:
+        name (str): The filter, one of FILTERS.
+
+    Returns:
+        run (callable): A function of (noisy_im, patch_size, search_dist, dtype).
+    '''
+    if name == 'quad':
+        from filters.quadratic_filter import quadratic_filter
+        return lambda im, patch_size, search_dist, dtype: quadratic_filter(im, 5, dtype=dtype)
+    elif name == 'TV':
+        from filters.TV_filter import TV_filter
+        return lambda im, patch_size, search_dist, dtype: TV_filter(im, 0.3, dtype=dtype)
+    elif name == 'TV_pd':
+        from filters.TV_filter_pd import TV_filter_pd
+        return lambda im, patch_size, search_dist, dtype: TV_filter_pd(im, 6, dtype=dtype)
+    elif name == 'nlm':
+        from filters.non_local_means_filter import non_local_means_filter
+        return lambda im, patch_size, search_dist, dtype: non_local_means_filter(im, patch_size, search_dist, 0.1, dtype=dtype)
+    elif name == 'wnnm':
+        from filters.non_local_wnnm_filter import non_local_wnnm_filter
+        return lambda im, patch_size, search_dist, dtype: non_local_wnnm_filter(im, patch_size, search_dist, 0.01, dtype=dtype)
+    raise ValueError(f'Unknown filter: {name}')
+
+
+def make_input(size, batch, image='boat', dtype=np.float64):
+    '''Builds a reproducible noisy input of the requested size.
+
+    Args:
+        size (int): The side length of the image.
+        batch (int): The number of images to stack. A batch of 1 returns a single 2D image.
+        image (str): The image to resize.
+        dtype (np.dtype): The floating point type of the noisy image.
+
+    Returns:
+        im (np.ndarray): The original image.
+        noisy_im (np.ndarray): The noisy image, or (batch, size, size) stack of them.
+    '''
+    np.random.seed(0)
+    im = read_image(image, size=(size, size))
+    noisy_im = np.stack([add_gaussian_noise(im, mean=0, var=0.01, dtype=dtype) for _ in range(batch)])
+    return im, (noisy_im[0] if batch == 1 else noisy_im)
+
+
+def time_case(run, noisy_im, patch_size, search_dist, dtype, warmup, repeats):
+    '''Times the filter and normalization stages of one case.
+
+    Args:
+        run (callable): The filter, as returned by get_filter.
+        noisy_im (np.ndarray): The input image(s).
+        patch_size (int): The patch size passed to the patch filters.
+        search_dist (int): The search distance passed to the patch filters.
+        dtype (np.dtype): The floating point type the filter computes in.
+        warmup (int): The number of untimed runs.
+        repeats (int): The number of timed runs.
+
+    Returns:
+        stats (dict): The timing percentiles of each stage (seconds) and the peak traced memory (bytes).
+    '''
+    for _ in range(warmup):
+        run(noisy_im, patch_size, search_dist, dtype)
+
+    filter_times, normalize_times = [], []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        clean_im = run(noisy_im, patch_size, search_dist, dtype)
+        filter_time = time.perf_counter()
+        normalize_image(clean_im)
+        normalize_time = time.perf_counter()
+        filter_times.append(filter_time - start_time)
+        normalize_times.append(normalize_time - filter_time)
+
+    # Tracing slows allocations down, so memory is measured in a separate run
+    tracemalloc.start()
+    run(noisy_im, patch_size, search_dist, dtype)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = {'peak_memory': peak_memory}
+    for stage, times in [('filter', filter_times), ('normalize', normalize_times)]:
+        p10, median, p90 = np.percentile(times, [10, 50, 90])
+        stats[f'{stage}_time'] = {'median': median, 'p10': p10, 'p90': p90, 'min': min(times), 'repeats': len(times)}
+    return stats
+
+
+def fit_scaling(cases):
+    '''Fits the exponent of runtime against pixel count (log-log slope) for every
+       filter and parameter combination measured at more than one image size.
+
+    Args:
+        cases (list): The benchmark cases.
+
+    Returns:
+        scaling (list): The fitted exponent of each combination.
+    '''
+    groups = {}
+    for case in cases:
+        key = (case['filter'], case['patch_size'], case['search_dist'], case['batch'], case['dtype'])
+        groups.setdefault(key, []).append((case['size']**2 * case['batch'], case['filter_median']))
+
+    scaling = []
+    for (name, patch_size, search_dist, batch, dtype), points in groups.items():
+        if len(points) < 2:
+            continue
+        pixels, seconds = np.log(np.array(points)).T
+        exponent = np.polyfit(pixels, seconds, 1)[0]
+        scaling.append({'filter': name, 'patch_size': patch_size, 'search_dist': search_dist, 'batch': batch, 'dtype': dtype,
+                        'exponent': exponent})
+    return scaling
+
+
+def run_benchmarks(filters, sizes, patch_sizes, search_dists, batches, dtypes=('float64',), warmup=1, repeats=5):
+    '''Runs every benchmark case. The patch size and search distance are only swept for the patch filters.
+
+    Every case also records the PSNR of its output. When float64 is among the dtypes, the
+    other dtypes are reported with their PSNR difference from the float64 reference.
+
+    Args:
+        filters (list): The filters to benchmark.
+        sizes (list): The image side lengths.
+        patch_sizes (list): The patch sizes.
+        search_dists (list): The search distances.
+        batches (list): The batch sizes.
+        dtypes (list): The names of the floating point types to compute in.
+        warmup (int): The number of untimed runs per case.
+        repeats (int): The number of timed runs per case.
+
+    Returns:
+        report (dict): The environment, cases and scaling fits.
+    '''
+    cases = []
+    for name in filters:
+        try:
+            run = get_filter(name)
+        except ImportError as e:
+            print(f'[WARNING] Skipping {name}: {e}')
+            continue
+
+        if name in PATCH_FILTERS:
+            params = list(product(patch_sizes, search_dists))
+        else:
+            params = [(None, None)]
+
+        for size, batch, (patch_size, search_dist) in product(sizes, batches, params):
+            reference_psnr = None
+            for dtype in sorted(dtypes, key=lambda dtype: dtype != 'float64'):
+                im, noisy_im = make_input(size, batch, dtype=dtype)
+                stats = time_case(run, noisy_im, patch_size, search_dist, dtype, warmup, repeats)
+                psnr = PSNR(original_im=im, cleaned_im=normalize_image(run(noisy_im, patch_size, search_dist, dtype)))
+                if dtype == 'float64':
+                    reference_psnr = psnr
+                case = {'filter': name, 'size': size, 'batch': batch, 'patch_size': patch_size, 'search_dist': search_dist,
+                        'dtype': dtype, 'filter_median': stats['filter_time']['median'], 'PSNR': psnr,
+                        'PSNR_delta': None if reference_psnr is None else psnr - reference_psnr, **stats}
+                cases.append(case)
+                print(f'{name:6s} size={size:<5d} batch={batch:<3d} patch={patch_size} search={search_dist} dtype={dtype} '
+                      f'median={case["filter_median"]:.4f}s peak={stats["peak_memory"] / 2**20:.1f}MiB PSNR={psnr:.4f}')
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                   'processor': platform.processor(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'environment': environment, 'cases': cases, 'scaling': fit_scaling(cases)}
+
+
+def compare_reports(report, baseline, threshold=0.1):
+    '''Compares the median filter time of every case found in both reports.
+
+    Args:
+        report (dict): The new benchmark report.
+        baseline (dict): The baseline benchmark report.
+        threshold (float): The relative slowdown above which a case counts as a regression.
+
+    Returns:
+        regressions (list): The cases that got slower than the threshold allows.
+    '''
+    def key(case):
+        return (case['filter'], case['size'], case['batch'], case['patch_size'], case['search_dist'], case.get('dtype', 'float64'))
+
+    baseline_cases = {key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in report['cases']:
+        old_case = baseline_cases.get(key(case))
+        if old_case is None:
+            continue
+        ratio = case['filter_median'] / old_case['filter_median']
+        memory_ratio = case['peak_memory'] / max(old_case['peak_memory'], 1)
+        status = 'REGRESSION' if ratio > 1 + threshold else ('faster' if ratio < 1 - threshold else 'same')
+        print(f'{"/".join(str(k) for k in key(case)):30s} time x{ratio:.2f} memory x{memory_ratio:.2f} {status}')
+        if status == 'REGRESSION':
+            regressions.append(case)
+    return regressions
+
+
+def parse_args(argv=None):
+    '''Parses the command line arguments.
+
+    Args:
+        argv (list): The arguments. Defaults to sys.argv.
+
+    Returns:
+        args (argparse.Namespace): The parsed arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filters', nargs='+', default=FILTERS, choices=FILTERS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 128, 256])
+    parser.add_argument('--patch-sizes', nargs='+', type=int, default=[7])
+    parser.add_argument('--search-dists', nargs='+', type=int, default=[5, 10])
+    parser.add_argument('--batches', nargs='+', type=int, default=[1])
+    parser.add_argument('--dtypes', nargs='+', default=['float64'], choices=['float64', 'float32'])
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default='bench.json', help='The JSON file the report is written to.')
+    parser.add_argument('--compare', help='A previous report to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='The relative slowdown reported as a regression.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_benchmarks(args.filters, args.sizes, args.patch_sizes, args.search_dists, args.batches, args.dtypes,
+                            args.warmup, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for fit in report['scaling']:
+        print(f'{fit["filter"]:6s} patch={fit["patch_size"]} search={fit["search_dist"]} batch={fit["batch"]} dtype={fit["dtype"]} '
+              f'time ~ pixels^{fit["exponent"]:.2f}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_reports(report, baseline, args.threshold):
+            sys.exit(1)
@@ -1,29 +1,181 @@
 '''Total Variation (L1) Filter'''
-import cvxpy as cp
+import numpy as np
 
+from filters.instrumentation import count, progress, timed
+from filters.spectral import solve_screened_poisson
 
-def TV_filter(im, lamb=1):
+
+_problems = {}
+_GAP_EVERY = 10
+
+
+def TV_filter(im, lamb=1, dtype=np.float64, instrument=None, backend='bregman', niter=500, gap_tol=1e-4):
     '''Total Variation (L1) Filter.
 
+    Minimizes ||X - Y||^2 + lamb * (||Dx X||_1 + ||Dy X||_1), the anisotropic TV
+    denoising problem. The default 'bregman' backend runs split Bregman iterations, whose
+    quadratic subproblems are solved in closed form by the DCT (see filters.spectral), and
+    stops once the relative primal-dual gap, which bounds how far the objective is from its
+    optimum, falls below gap_tol. The 'cvxpy' backend solves the same problem with cvxpy,
+    one image of a stack at a time. Its problem is built once per image shape, with the
+    image and lambda as parameters, and every solve is warm-started from the previous
+    solution of that shape.
+
     Args:
-        im (np.ndarray): The noisy image to be filtered.
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
         lamb (float): The free parameter (lambda) that determines how much to correct.
+        dtype (np.dtype): The floating point type of the result. The bregman backend also
+            computes in it, while cvxpy always solves in float64.
+        instrument (Instrumentation): If given, times the solve and, for the bregman backend,
+            collects the iteration count and the progress of the iterations.
+        backend (str): The solver to use, either 'bregman' or 'cvxpy'.
+        niter (int): The maximum number of split Bregman iterations.
+        gap_tol (float): The relative primal-dual gap at which the split Bregman iterations stop.
+            A stack of images stops as a whole.
 
     Returns:
-        clean_im (np.ndarray): The filtered image.
+        clean_im (np.ndarray): The filtered image (or stack of images).
     '''
 
-    X = cp.Variable(im.shape)
-    dXdx = cp.diff(X, k=1, axis=0)
-    dXdy = cp.diff(X, k=1, axis=1)
-    objective = cp.Minimize(cp.sum_squares(X - im) + lamb * cp.pnorm(dXdx, 1) + lamb * cp.pnorm(dXdy, 1))
+    if backend not in ('bregman', 'cvxpy'):
+        raise ValueError(f'Unknown TV filter backend: {backend}')
+
+    if backend == 'bregman':
+        with timed(instrument, 'solve'):
+            return _TV_filter_bregman(np.asarray(im, dtype=dtype), lamb, niter, gap_tol, instrument)
+
+    if im.ndim == 3:
+        return np.stack([TV_filter(single_im, lamb, dtype, instrument, backend) for single_im in im])
+
+    import cvxpy as cp
 
-    prob = cp.Problem(objective)
+    prob, X, Y, lamb_param = _problem(im.shape)
+    Y.value = np.asarray(im, dtype=np.float64)
+    lamb_param.value = lamb
     try:
-        prob.solve(verbose=True)
+        with timed(instrument, 'solve'):
+            prob.solve(warm_start=True, verbose=False)
     except cp.SolverError as e:
-        print('[ERROR] TV Filter Failed.')
-        print(e)
-        exit()
-    clean_im = X.value
+        raise RuntimeError(f'TV filter failed: {e}') from e
+    clean_im = X.value.astype(dtype)
+    return clean_im
+
+
+def _TV_filter_bregman(im, lamb, niter, gap_tol, instrument=None):
+    '''Anisotropic TV filter solved with split Bregman iterations.
+
+    The gradients are split off as d = DX, which turns every iteration into a screened
+    Poisson solve for X, a soft threshold for d and an update of the Bregman variable b.
+
+    Args:
+        im (np.ndarray): The noisy image, or a (B, n, m) stack of them.
+        lamb (float): The free parameter (lambda) that determines how much to correct.
+        niter (int): The maximum number of iterations.
+        gap_tol (float): The relative primal-dual gap at which to stop.
+        instrument (Instrumentation): If given, collects the iteration count and progress.
+
+    Returns:
+        clean_im (np.ndarray): The filtered image (or stack of images).
+    '''
+    if lamb == 0:
+        return im.copy()
+
+    # This penalty converged fastest over lambdas from 0.05 to 6 on the test images
+    mu = 40 * lamb
+    threshold = lamb / mu
+
+    clean_im = im.copy()
+    d = list(_gradient(clean_im))
+    b = [np.zeros_like(d_axis) for d_axis in d]
+
+    it = 0
+    for it in range(1, niter + 1):
+        clean_im = solve_screened_poisson(im + (mu / 2) * _gradient_adjoint(d[0] - b[0], d[1] - b[1]), mu / 2)
+        for axis, grad in enumerate(_gradient(clean_im)):
+            grad += b[axis]
+            d[axis] = np.sign(grad) * np.maximum(np.abs(grad) - threshold, 0)
+            b[axis] = grad - d[axis]
+
+        # The scaled Bregman variable is a feasible dual point, which bounds the objective from below
+        if it % _GAP_EVERY == 0 or it == niter:
+            progress(instrument, 'iterations', it, niter)
+            if _relative_gap(clean_im, im, lamb, mu * b[0] / lamb, mu * b[1] / lamb) < gap_tol:
+                break
+    count(instrument, 'iterations', it)
     return clean_im
+
+
+def _gradient(im):
+    '''Forward differences of an image, stopping at the border.
+
+    Args:
+        im (np.ndarray): The (..., n, m) image.
+
+    Returns:
+        dx (np.ndarray): The (..., n - 1, m) differences along the rows.
+        dy (np.ndarray): The (..., n, m - 1) differences along the columns.
+    '''
+    return np.diff(im, axis=-2), np.diff(im, axis=-1)
+
+
+def _gradient_adjoint(dx, dy):
+    '''Applies the adjoint of _gradient, i.e. minus the divergence.
+
+    Args:
+        dx (np.ndarray): The (..., n - 1, m) differences along the rows.
+        dy (np.ndarray): The (..., n, m - 1) differences along the columns.
+
+    Returns:
+        im (np.ndarray): The (..., n, m) result.
+    '''
+    pad_rows = [(0, 0)] * (dx.ndim - 2) + [(1, 1), (0, 0)]
+    pad_cols = [(0, 0)] * (dy.ndim - 2) + [(0, 0), (1, 1)]
+    return -np.diff(np.pad(dx, pad_rows), axis=-2) - np.diff(np.pad(dy, pad_cols), axis=-1)
+
+
+def _relative_gap(clean_im, im, lamb, px, py):
+    '''Calculates the primal-dual gap of the anisotropic TV problem, relative to the objective.
+
+    The dual of the problem is max lamb * <D^T p, Y> - lamb^2 / 4 * ||D^T p||^2 over |p| <= 1.
+
+    Args:
+        clean_im (np.ndarray): The current image.
+        im (np.ndarray): The noisy image.
+        lamb (float): The free parameter (lambda).
+        px (np.ndarray): The dual variable of the differences along the rows.
+        py (np.ndarray): The dual variable of the differences along the columns.
+
+    Returns:
+        gap (float): The relative primal-dual gap.
+    '''
+    dx, dy = _gradient(clean_im)
+    primal = np.sum(np.square(clean_im - im), dtype=np.float64) + \
+        lamb * (np.sum(np.abs(dx), dtype=np.float64) + np.sum(np.abs(dy), dtype=np.float64))
+    div = _gradient_adjoint(np.clip(px, -1, 1), np.clip(py, -1, 1))
+    dual = lamb * np.sum(div * im, dtype=np.float64) - lamb**2 / 4 * np.sum(np.square(div), dtype=np.float64)
+    return (primal - dual) / max(primal, 1e-12)
+
+
+def _problem(shape):
+    '''Builds (or reuses) the parametrized TV problem of an image shape.
+
+    Args:
+        shape (tuple): The shape of the image.
+
+    Returns:
+        prob (cp.Problem): The problem.
+        X (cp.Variable): The filtered image.
+        Y (cp.Parameter): The noisy image.
+        lamb (cp.Parameter): The free parameter (lambda).
+    '''
+    import cvxpy as cp
+
+    if shape not in _problems:
+        X = cp.Variable(shape)
+        Y = cp.Parameter(shape)
+        lamb = cp.Parameter(nonneg=True)
+        dXdx = cp.diff(X, k=1, axis=0)
+        dXdy = cp.diff(X, k=1, axis=1)
+        objective = cp.Minimize(cp.sum_squares(X - Y) + lamb * cp.pnorm(dXdx, 1) + lamb * cp.pnorm(dXdy, 1))
+        _problems[shape] = (cp.Problem(objective), X, Y, lamb)
+    return _problems[shape]
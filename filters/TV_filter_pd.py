@@ -1,41 +1,145 @@
 '''Total Variation (L1) Filter'''
 import numpy as np
 
+from filters.instrumentation import count, progress, timed
 
-def TV_filter_pd(im, lamb=1, niter=100):
+
+def TV_filter_pd(im, lamb=1, niter=100, tau=None, accelerate=False, tol=None, gap_tol=None, return_stats=False, dtype=np.float64,
+                 instrument=None):
     '''Total Variation (L1) Filter coded using the primal dual algorithm.
 
+    All iterates live in preallocated buffers that are updated in place. With
+    accelerate=True the step sizes follow the accelerated primal-dual scheme of
+    Chambolle and Pock, which uses the strong convexity of the data term. Images of any
+    (n, m) shape are supported, and memory use is a fixed number of image-sized buffers.
+    A (B, n, m) stack of images is filtered in one pass, in which case the stopping
+    criteria apply to the stack as a whole.
+
     Args:
-        im (np.ndarray): The noisy image to be filtered.
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
         lamb (float): The free parameter (lambda) that determines how much to correct.
-        niter (int): The number of iterations to run.
+        niter (int): The maximum number of iterations to run.
+        tau (float): The (initial) primal step size. Defaults to 0.02, or 2.0 when accelerating,
+            since the accelerated scheme shrinks the step as it goes.
+        accelerate (bool): Whether to use the accelerated step sizes and over-relaxation.
+        tol (float): If given, stops once the relative change of the image between two
+            iterations falls below this value.
+        gap_tol (float): If given, stops once the relative primal-dual gap falls below this value.
+        return_stats (bool): Whether to also return the iteration statistics.
+        dtype (np.dtype): The floating point type of the iterates, e.g. np.float32 to halve
+            the memory traffic of each iteration.
+        instrument (Instrumentation): If given, collects the iteration count, the solve time
+            and the progress of the iterations.
 
     Returns:
-        clean_im (np.ndarray): The filtered image.
+        clean_im (np.ndarray): The filtered image (or stack of images).
+        stats (dict): The iteration statistics, only returned if return_stats is True.
     '''
-    tau = 0.02
+    if tau is None:
+        tau = 2.0 if accelerate else 0.02
     sigma = 1.0 / (8.0 * tau)
-    lt = lamb * tau
-    n = im.shape[0]
+    clean_im = np.array(im, dtype=dtype)
+    target = lamb * clean_im
+
+    prev_im = np.empty_like(clean_im)
+    step_im = clean_im if not accelerate else clean_im.copy()
+    grad = np.empty((2,) + clean_im.shape, dtype=dtype)
+    div = np.empty_like(clean_im)
+    norm = np.empty_like(clean_im)
+    scratch = np.empty_like(clean_im)
+    track_change = accelerate or tol is not None
 
-    clean_im = im
-    shift = list(range(1, n)) + [n - 1]
+    p = np.empty_like(grad)
+    _gradient(clean_im, p)
 
-    p = np.zeros((n, n, 2))
-    p[:, :, 0] = clean_im[:, shift] - clean_im
-    p[:, :, 1] = clean_im[shift, :] - clean_im
+    stats = {'iterations': 0, 'converged': False, 'rel_change': None, 'gap': None}
+    with timed(instrument, 'primal_dual'):
+        for it in range(niter):
+            _gradient(step_im, grad)
+            grad *= sigma
+            p += grad
 
-    for _ in range(niter):
-        ux = clean_im[:, shift] - clean_im
-        uy = clean_im[shift, :] - clean_im
-        p = p + sigma * np.dstack([ux, uy])
+            np.multiply(p[0], p[0], out=norm)
+            np.multiply(p[1], p[1], out=scratch)
+            norm += scratch
+            np.sqrt(norm, out=norm)
+            np.maximum(norm, 1, out=norm)
+            p /= norm
 
-        normep = np.maximum(1, np.sqrt(np.square(p[:, :, 0]) + np.square(p[:, :, 1])))
-        p[:, :, 0] = p[:, :, 0] / normep
-        p[:, :, 1] = p[:, :, 1] / normep
+            _divergence(p, div)
 
-        div = np.vstack((p[0:n - 1, :, 1], np.zeros((1, n)))) - np.vstack((np.zeros((1, n)), p[0:n - 1, :, 1]))
-        div = np.hstack((p[:, 0:n - 1, 0], np.zeros((n, 1)))) - np.hstack((np.zeros((n, 1)), p[:, 0:n - 1, 0])) + div
+            if track_change:
+                prev_im[...] = clean_im
+            np.multiply(div, tau, out=scratch)
+            clean_im += scratch
+            np.multiply(target, tau, out=scratch)
+            clean_im += scratch
+            clean_im /= 1 + tau
 
-        clean_im = (clean_im + tau * div + lt * im) / (1 + tau)
+            if accelerate:
+                theta = 1 / np.sqrt(1 + 2 * tau)
+                tau *= theta
+                sigma /= theta
+                np.subtract(clean_im, prev_im, out=step_im)
+                step_im *= theta
+                step_im += clean_im
+
+            stats['iterations'] = it + 1
+            progress(instrument, 'iterations', it + 1, niter)
+            if tol is not None:
+                stats['rel_change'] = np.linalg.norm(clean_im - prev_im) / max(np.linalg.norm(clean_im), 1e-12)
+            if gap_tol is not None:
+                stats['gap'] = _relative_gap(clean_im, div, target, grad)
+            if (tol is not None and stats['rel_change'] < tol) or (gap_tol is not None and stats['gap'] < gap_tol):
+                stats['converged'] = True
+                break
+    count(instrument, 'iterations', stats['iterations'])
+
+    if return_stats:
+        return clean_im, stats
     return clean_im
+
+
+def _gradient(im, grad):
+    '''Computes the forward difference gradient of an image (or stack of images) in place.
+
+    Args:
+        im (np.ndarray): The (..., n, m) image.
+        grad (np.ndarray): The (2, ..., n, m) buffer receiving the horizontal and vertical differences.
+    '''
+    np.subtract(im[..., :, 1:], im[..., :, :-1], out=grad[0, ..., :, :-1])
+    grad[0, ..., :, -1] = 0
+    np.subtract(im[..., 1:, :], im[..., :-1, :], out=grad[1, ..., :-1, :])
+    grad[1, ..., -1, :] = 0
+
+
+def _divergence(p, div):
+    '''Computes the divergence (the negative adjoint of the gradient) of a dual field in place.
+
+    Args:
+        p (np.ndarray): The (2, ..., n, m) dual field.
+        div (np.ndarray): The (..., n, m) buffer receiving the divergence.
+    '''
+    div[..., :, :-1] = p[0, ..., :, :-1]
+    div[..., :, -1] = 0
+    div[..., :, 1:] -= p[0, ..., :, :-1]
+    div[..., :-1, :] += p[1, ..., :-1, :]
+    div[..., 1:, :] -= p[1, ..., :-1, :]
+
+
+def _relative_gap(clean_im, div, target, grad):
+    '''Calculates the relative primal-dual gap of min_u ||grad u||_1 + 0.5||u - target||^2.
+
+    Args:
+        clean_im (np.ndarray): The current primal iterate.
+        div (np.ndarray): The divergence of the current dual iterate.
+        target (np.ndarray): The target image of the data term.
+        grad (np.ndarray): A (2, n, m) scratch buffer.
+
+    Returns:
+        gap (float): The primal-dual gap divided by the primal objective.
+    '''
+    _gradient(clean_im, grad)
+    primal = np.sum(np.sqrt(np.square(grad[0]) + np.square(grad[1]))) + 0.5 * np.sum(np.square(clean_im - target))
+    dual = -np.sum(target * div) - 0.5 * np.sum(np.square(div))
+    return (primal - dual) / max(abs(primal), 1e-12)
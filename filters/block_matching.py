@@ -0,0 +1,280 @@
+'''Block matching: exact search of a window, or approximate search through a nearest-neighbour index. '''
+import numpy as np
+
+from filters.patch_utils import reference_centers, search_offsets, strided_patch_distances
+
+
+def similar_patches(padded_im, patch_size, search_dist, centers, group_size, max_distance):
+    '''Finds the most similar patches to every reference patch of a block of a stack of images.
+
+    Args:
+        padded_im (np.ndarray): The (B, n, m) stack of padded images.
+        patch_size (int): The size of patches to consider.
+        search_dist (int): The distance from the center pixel of a patch to look.
+        centers (tuple): The increasing row and col indices of the reference patch centers.
+        group_size (int): The maximum number of patches in a group.
+        max_distance (float): The largest distance between a reference patch and its matches.
+
+    Returns:
+        ref_images (np.ndarray): The image of each reference patch.
+        ref_rows (np.ndarray): The row of each reference patch center.
+        ref_cols (np.ndarray): The col of each reference patch center.
+        match_rows (np.ndarray): The rows of the similar patches, closest first, one row per reference.
+        match_cols (np.ndarray): The cols of the similar patches, closest first, one row per reference.
+        match_distances (np.ndarray): The distances of the similar patches, one row per reference.
+        group_sizes (np.ndarray): The number of valid similar patches for each reference.
+    '''
+
+    pad = patch_size // 2
+    row_indices, col_indices = centers
+
+    # The reference patch itself comes first, so that it wins ties and always joins its group
+    offsets = search_offsets(search_dist)
+    offsets.remove((0, 0))
+    offsets = np.array([(0, 0)] + offsets)
+
+    # Only the windows of the (possibly strided) centers are summed, so a stride of s cuts the work by about s**2
+    distances = np.full((len(offsets), padded_im.shape[0], len(row_indices), len(col_indices)), np.inf, dtype=padded_im.dtype)
+    for idx, (d_row, d_col) in enumerate(offsets):
+        ssd, (rows, cols) = strided_patch_distances(padded_im, pad, d_row, d_col, centers)
+        if ssd.size == 0:
+            continue
+        distances[idx, :, rows, cols] = np.sqrt(ssd)
+
+    distances[distances > max_distance] = np.inf
+    distances = distances.reshape(len(offsets), -1).T
+
+    # Keep the closest patches, ordered by distance and then by offset
+    group_size = min(group_size, len(offsets))
+    nearest = np.argpartition(distances, group_size - 1, axis=1)[:, :group_size]
+    nearest.sort(axis=1)
+    nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+    order = np.argsort(nearest_distances, axis=1, kind='stable')
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+    group_sizes = np.isfinite(nearest_distances).sum(axis=1)
+
+    ref_images, ref_rows, ref_cols = reference_centers(padded_im.shape[0], centers)
+    match_rows = ref_rows[:, None] + offsets[nearest, 0]
+    match_cols = ref_cols[:, None] + offsets[nearest, 1]
+    return ref_images, ref_rows, ref_cols, match_rows, match_cols, nearest_distances, group_sizes
+
+
+def pca_components(flat_patches, n_components, sample_size=10000, seed=0):
+    '''Fits the principal components of a random sample of patches.
+
+    Args:
+        flat_patches (np.ndarray): The (..., patch_size**2) flattened patches.
+        n_components (int): The number of components.
+        sample_size (int): The number of patches the components are fitted on.
+        seed (int): The seed of the sample.
+
+    Returns:
+        components (np.ndarray): The (patch_size**2, n_components) projection matrix.
+    '''
+    rng = np.random.default_rng(seed)
+    flat_patches = flat_patches.reshape(-1, flat_patches.shape[-1])
+    sample = flat_patches[rng.choice(len(flat_patches), min(sample_size, len(flat_patches)), replace=False)]
+    _, _, vh = np.linalg.svd(sample - sample.mean(axis=0), full_matrices=False)
+    return vh[:n_components].T
+
+
+class PatchIndex:
+    '''Finds similar patches through a KD-tree over low-dimensional projections of every
+       patch, instead of comparing each reference patch with its whole search window.
+
+    The candidates returned by the tree are re-ranked with their exact patch distances,
+    so the index only trades recall (see matching_recall) for speed, never accuracy of the
+    distances themselves. Without a search window, one tree per image serves a global
+    non-local search. With a window, the reference patches are split into cells of about
+    search_dist pixels, and each cell queries a tree of only the patches its windows can
+    reach, asking for more neighbours until every reference has its candidates inside its
+    own window. The cost then grows with the window much more slowly than the exact search.
+
+    Args:
+        n_components (int): The number of dimensions each patch is projected to.
+        projection (str): How patches are projected, either 'pca' or 'random'.
+        oversample (int): The number of candidates taken from the tree per patch of a
+            group, before re-ranking.
+        search_dist (int): The distance from the reference patch center that matches must
+            lie within. If None, every patch of the image (or tile) is a candidate.
+        eps (float): The approximation allowed in the tree search, which returns candidates
+            within (1 + eps) times the true nearest distances.
+        sample_size (int): The number of patches the PCA is fitted on.
+        seed (int): The seed of the patch sample and of the random projection.
+    '''
+
+    def __init__(self, n_components=8, projection='pca', oversample=2, search_dist=None, eps=1.0, sample_size=10000, seed=0):
+        if projection not in ('pca', 'random'):
+            raise ValueError(f'Unknown patch projection: {projection}')
+        self.n_components = n_components
+        self.projection = projection
+        self.oversample = oversample
+        self.search_dist = search_dist
+        self.eps = eps
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def build(self, patches):
+        '''Projects every patch and builds one tree per image.
+
+        Args:
+            patches (np.ndarray): The (B, n, m, patch_size, patch_size) patches of a stack of
+                images, with one patch per top-left corner.
+
+        Returns:
+            trees (list): The KD-tree of the projected patches of each image. With a search
+                window, the (n, m, n_components) projected patches of each image instead, whose
+                trees are built one cell at a time by similar_patches.
+        '''
+        from scipy.spatial import cKDTree
+
+        num_images, n, m, patch_size, _ = patches.shape
+        flat_patches = patches.reshape(num_images, n * m, patch_size * patch_size)
+        components = self._components(flat_patches)
+        if self.search_dist is not None:
+            return [(flat_patches[idx] @ components).reshape(n, m, -1) for idx in range(num_images)]
+        return [cKDTree(flat_patches[idx] @ components) for idx in range(num_images)]
+
+    def _components(self, flat_patches):
+        '''Calculates the projection matrix of the patches.
+
+        Args:
+            flat_patches (np.ndarray): The (B, N, patch_size**2) flattened patches.
+
+        Returns:
+            components (np.ndarray): The (patch_size**2, n_components) projection matrix.
+        '''
+        rng = np.random.default_rng(self.seed)
+        dims = flat_patches.shape[-1]
+        n_components = min(self.n_components, dims)
+        if self.projection == 'random':
+            return rng.standard_normal((dims, n_components)).astype(flat_patches.dtype) / np.sqrt(n_components)
+
+        return pca_components(flat_patches, n_components, self.sample_size, self.seed)
+
+    def similar_patches(self, trees, patches, centers, group_size, max_distance):
+        '''Finds the most similar patches to every reference patch of a block of a stack of images.
+
+        Args:
+            trees (list): The trees of each image, as returned by build.
+            patches (np.ndarray): The (B, n, m, patch_size, patch_size) patches the trees were built from.
+            centers (tuple): The row and col indices of the reference patch centers in the padded images.
+            group_size (int): The maximum number of patches in a group.
+            max_distance (float): The largest distance between a reference patch and its matches.
+
+        Returns:
+            The same arrays as the exact block matching: ref_images, ref_rows, ref_cols,
+            match_rows, match_cols, match_distances and group_sizes.
+        '''
+        num_images, n, m, patch_size, _ = patches.shape
+        pad = patch_size // 2
+        ref_images, ref_rows, ref_cols = reference_centers(num_images, centers)
+        ref_flat = (ref_rows - pad) * m + (ref_cols - pad)
+
+        # The reference patch always leads its own group, followed by the candidates of the tree
+        num_candidates = min(self.oversample * group_size, n * m)
+        candidates = np.empty((len(ref_flat), num_candidates + 1), dtype=np.int64)
+        candidates[:, 0] = ref_flat
+        if self.search_dist is not None:
+            candidates[:, 1:] = self._window_candidates(trees, ref_images, ref_rows - pad, ref_cols - pad, num_candidates)
+        else:
+            for idx, tree in enumerate(trees):
+                members = np.flatnonzero(ref_images == idx)
+                ref_features = tree.data[ref_flat[members]]
+                _, nearest = tree.query(ref_features, k=num_candidates, eps=self.eps)
+                candidates[members, 1:] = nearest.reshape(len(members), num_candidates)
+
+        cand_rows, cand_cols = np.divmod(candidates, m)
+        ref_patches = patches[ref_images, ref_rows - pad, ref_cols - pad]
+        cand_patches = patches[ref_images[:, None], cand_rows, cand_cols]
+        distances = np.sqrt(np.sum(np.square(cand_patches - ref_patches[:, None]), axis=(-2, -1)))
+
+        distances[:, 1:][candidates[:, 1:] == ref_flat[:, None]] = np.inf
+        if self.search_dist is not None:
+            outside = (np.abs(cand_rows + pad - ref_rows[:, None]) > self.search_dist) | \
+                      (np.abs(cand_cols + pad - ref_cols[:, None]) > self.search_dist)
+            distances[outside] = np.inf
+        distances[:, 1:][distances[:, 1:] > max_distance] = np.inf
+
+        group_size = min(group_size, num_candidates + 1)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :group_size]
+        match_distances = np.take_along_axis(distances, order, axis=1)
+        group_sizes = np.isfinite(match_distances).sum(axis=1)
+        match_rows = np.take_along_axis(cand_rows, order, axis=1) + pad
+        match_cols = np.take_along_axis(cand_cols, order, axis=1) + pad
+        return ref_images, ref_rows, ref_cols, match_rows, match_cols, match_distances, group_sizes
+
+    def _window_candidates(self, features, ref_images, ref_rows, ref_cols, num_candidates):
+        '''Finds the nearest projected patches inside the search window of every reference patch.
+
+        Args:
+            features (list): The (n, m, n_components) projected patches of each image, as returned by build.
+            ref_images (np.ndarray): The image of each reference patch.
+            ref_rows (np.ndarray): The top row of each reference patch.
+            ref_cols (np.ndarray): The left col of each reference patch.
+            num_candidates (int): The number of candidates to find for each reference patch.
+
+        Returns:
+            candidates (np.ndarray): The flat (row * m + col) top-left corner of the candidates of
+                each reference patch, nearest first. References whose window holds fewer patches
+                are padded with themselves.
+        '''
+        from scipy.spatial import cKDTree
+
+        n, m = features[0].shape[:2]
+        reach = self.search_dist
+        cell_size = max(reach, 1)
+        candidates = np.repeat((ref_rows * m + ref_cols)[:, None], num_candidates, axis=1)
+
+        cells = np.stack([ref_images, ref_rows // cell_size, ref_cols // cell_size])
+        _, cell_ids = np.unique(cells, axis=1, return_inverse=True)
+        for members in np.split(np.argsort(cell_ids.ravel(), kind='stable'), np.cumsum(np.bincount(cell_ids.ravel()))[:-1]):
+            rows, cols = ref_rows[members], ref_cols[members]
+            top, bottom = max(rows.min() - reach, 0), min(rows.max() + reach + 1, n)
+            left, right = max(cols.min() - reach, 0), min(cols.max() + reach + 1, m)
+            cell_features = features[ref_images[members[0]]][top:bottom, left:right]
+            tree = cKDTree(cell_features.reshape(-1, cell_features.shape[-1]))
+
+            # Ask for more neighbours until every window holds enough of them, or the tree is exhausted
+            num_neighbours = min(2 * num_candidates, tree.n)
+            pending = np.arange(len(members))
+            while len(pending) > 0:
+                _, nearest = tree.query(cell_features[rows[pending] - top, cols[pending] - left], k=num_neighbours, eps=self.eps)
+                near_rows, near_cols = np.divmod(nearest.reshape(len(pending), num_neighbours), right - left)
+                near_rows += top
+                near_cols += left
+                inside = (np.abs(near_rows - rows[pending, None]) <= reach) & (np.abs(near_cols - cols[pending, None]) <= reach)
+                done = (inside.sum(axis=1) >= num_candidates) | (num_neighbours == tree.n)
+
+                order = np.argsort(~inside[done], axis=1, kind='stable')[:, :num_candidates]
+                found = np.take_along_axis(near_rows[done] * m + near_cols[done], order, axis=1)
+                found_inside = np.take_along_axis(inside[done], order, axis=1)
+                width = found.shape[1]
+                done_members = members[pending[done]]
+                candidates[done_members, :width] = np.where(found_inside, found, candidates[done_members, :width])
+
+                pending = pending[~done]
+                num_neighbours = min(4 * num_neighbours, tree.n)
+        return candidates
+
+
+def matching_recall(exact, approx):
+    '''Measures the fraction of the exact matches that an approximate block matching found.
+
+    Args:
+        exact (tuple): The (match_rows, match_cols, group_sizes) of the exact search.
+        approx (tuple): The (match_rows, match_cols, group_sizes) of the approximate search,
+            for the same reference patches.
+
+    Returns:
+        recall (float): The fraction of exact matches also present in the approximate groups.
+    '''
+    exact_rows, exact_cols, exact_sizes = exact
+    approx_rows, approx_cols, approx_sizes = approx
+
+    exact_valid = np.arange(exact_rows.shape[1]) < exact_sizes[:, None]
+    approx_valid = np.arange(approx_rows.shape[1]) < approx_sizes[:, None]
+    same = (exact_rows[:, :, None] == approx_rows[:, None, :]) & (exact_cols[:, :, None] == approx_cols[:, None, :])
+    found = np.any(same & approx_valid[:, None, :], axis=2) & exact_valid
+    return found.sum() / max(exact_valid.sum(), 1)
@@ -0,0 +1,125 @@
+'''Optional counters, timers and progress reporting for the filters' hot paths. '''
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+_NULL_TIMER = nullcontext()
+
+
+class Instrumentation:
+    '''Collects counters and timers from the filters and forwards every event to an
+       optional callback and/or logger.
+
+    Args:
+        callback (callable): Called as callback(kind, name, value) for every event, where
+            kind is 'count', 'time' or 'progress'.
+        logger (logging.Logger): If given, every event is logged at debug level.
+    '''
+
+    def __init__(self, callback=None, logger=None):
+        self.callback = callback
+        self.logger = logger
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+
+    def _emit(self, kind, name, value):
+        if self.callback is not None:
+            self.callback(kind, name, value)
+        if self.logger is not None:
+            self.logger.debug('%s %s: %s', kind, name, value)
+
+    def count(self, name, n=1):
+        '''Adds n to a counter.
+
+        Args:
+            name (str): The counter.
+            n (int): The amount to add.
+        '''
+        self.counters[name] += n
+        self._emit('count', name, n)
+
+    @contextmanager
+    def timer(self, name):
+        '''Times the enclosed block and adds it to a timer.
+
+        Args:
+            name (str): The timer (e.g. 'svd').
+        '''
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.timers[name] += elapsed
+            self._emit('time', name, elapsed)
+
+    def progress(self, name, done, total):
+        '''Reports the progress of a stage.
+
+        Args:
+            name (str): The stage.
+            done (int): The number of completed steps.
+            total (int): The total number of steps.
+        '''
+        self._emit('progress', name, (done, total))
+
+    def merge(self, counters, timers):
+        '''Adds the counters and timers collected elsewhere (e.g. in a worker process).
+
+        Args:
+            counters (dict): The counters to add.
+            timers (dict): The timers to add.
+        '''
+        for name, n in counters.items():
+            self.count(name, n)
+        for name, elapsed in timers.items():
+            self.timers[name] += elapsed
+            self._emit('time', name, elapsed)
+
+    def summary(self):
+        '''Returns the collected counters and timers.
+
+        Returns:
+            summary (dict): The counters and timers (in seconds).
+        '''
+        return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+
+def timed(instrument, name):
+    '''Times a block if instrumentation is enabled, and does nothing otherwise.
+
+    Args:
+        instrument (Instrumentation): The instrumentation, or None if disabled.
+        name (str): The timer.
+
+    Returns:
+        context (contextmanager): The context manager to time the block with.
+    '''
+    if instrument is None:
+        return _NULL_TIMER
+    return instrument.timer(name)
+
+
+def count(instrument, name, n=1):
+    '''Adds n to a counter if instrumentation is enabled.
+
+    Args:
+        instrument (Instrumentation): The instrumentation, or None if disabled.
+        name (str): The counter.
+        n (int): The amount to add.
+    '''
+    if instrument is not None:
+        instrument.count(name, n)
+
+
+def progress(instrument, name, done, total):
+    '''Reports the progress of a stage if instrumentation is enabled.
+
+    Args:
+        instrument (Instrumentation): The instrumentation, or None if disabled.
+        name (str): The stage.
+        done (int): The number of completed steps.
+        total (int): The total number of steps.
+    '''
+    if instrument is not None:
+        instrument.progress(name, done, total)
@@ -0,0 +1,251 @@
+'''Coarse-to-fine (pyramid) drivers for the patch-based filters.
+
+The wide search for similar patches only runs on the coarsest level of an image pyramid,
+where it is cheap. Every finer level inherits the matched offsets of the level below
+(doubled), refines each of them with a small local search and keeps the closest patches,
+so the cost at full resolution no longer depends on the search window.
+'''
+import numpy as np
+
+from filters.block_matching import pca_components, similar_patches
+from filters.instrumentation import timed
+from filters.non_local_wnnm_filter import non_local_wnnm_filter
+from filters.patch_utils import pad_images
+
+_BLOCK_ELEMENTS = 2**22
+
+
+def build_pyramid(im, levels):
+    '''Builds an image pyramid by repeatedly averaging 2x2 blocks of pixels.
+
+    Args:
+        im (np.ndarray): The image, or a (..., n, m) stack of them.
+        levels (int): The number of levels, including the image itself.
+
+    Returns:
+        pyramid (list): The levels, finest (the image) first. An odd last row or col is
+            dropped when halving.
+    '''
+    pyramid = [im]
+    for _ in range(levels - 1):
+        prev = pyramid[-1]
+        n, m = prev.shape[-2] // 2 * 2, prev.shape[-1] // 2 * 2
+        pyramid.append(0.25 * (prev[..., 0:n:2, 0:m:2] + prev[..., 1:n:2, 0:m:2] + prev[..., 0:n:2, 1:m:2] + prev[..., 1:n:2, 1:m:2]))
+    return pyramid
+
+
+def pyramid_matches(im, patch_size, levels=3, search_dist=10, num_matches=10, refine_dist=1, n_components=8):
+    '''Finds the closest patches to every patch of a stack of images, coarse to fine.
+
+    The coarsest level is searched exactly within search_dist, which covers about
+    search_dist * 2**(levels - 1) pixels at full resolution.
+
+    Args:
+        im (np.ndarray): The (B, n, m) stack of images.
+        patch_size (int): The size of patches to consider.
+        levels (int): The number of pyramid levels.
+        search_dist (int): The distance searched on the coarsest level.
+        num_matches (int): The number of matches kept for every patch, including itself.
+        refine_dist (int): The distance searched around every inherited offset on the finer levels.
+        n_components (int): The number of dimensions of the patch projections that rank the
+            candidates of the finer levels.
+
+    Returns:
+        offsets (np.ndarray): The (B, n, m, num_matches, 2) row and col offsets of the matches,
+            closest first. The first match of every patch is the patch itself.
+        distances (np.ndarray): The (B, n, m, num_matches) distances of the matches, inf for
+            offsets that fall outside the image.
+    '''
+    pad = patch_size // 2
+    pyramid = build_pyramid(im, levels)
+
+    offsets, distances = _search_matches(pad_images(pyramid[-1], pad), patch_size, search_dist, num_matches)
+    for level in reversed(pyramid[:-1]):
+        offsets, distances = _refine_matches(pad_images(level, pad), patch_size, offsets, refine_dist, num_matches, n_components)
+    return offsets, distances
+
+
+def _search_matches(padded_im, patch_size, search_dist, num_matches):
+    '''Finds the closest patches to every patch with an exact search of the window.
+
+    Args:
+        padded_im (np.ndarray): The (B, n, m) stack of padded images.
+        patch_size (int): The size of patches to consider.
+        search_dist (int): The distance from the center pixel of a patch to look.
+        num_matches (int): The number of matches kept for every patch.
+
+    Returns:
+        offsets (np.ndarray): The (B, n, m, num_matches, 2) offsets of the matches, closest first.
+        distances (np.ndarray): The (B, n, m, num_matches) distances of the matches.
+    '''
+    pad = patch_size // 2
+    num_images, n, m = padded_im.shape
+    shape = (num_images, n - 2 * pad, m - 2 * pad, min(num_matches, (2 * search_dist + 1)**2))
+    offsets = np.zeros(shape + (2,), dtype=np.int32)
+    distances = np.empty(shape, dtype=padded_im.dtype)
+
+    cols = np.arange(pad, m - pad)
+    block_rows = max(1, _BLOCK_ELEMENTS // (num_images * len(cols) * (2 * search_dist + 1)**2))
+    for start in range(pad, n - pad, block_rows):
+        centers = (np.arange(start, min(start + block_rows, n - pad)), cols)
+        _, ref_rows, ref_cols, match_rows, match_cols, match_distances, _ = similar_patches(padded_im, patch_size, search_dist, centers,
+                                                                                           num_matches, np.inf)
+        block = (slice(None), slice(start - pad, start - pad + len(centers[0])))
+        block_shape = distances[block].shape
+        offsets[block + (Ellipsis, 0)] = (match_rows - ref_rows[:, None]).reshape(block_shape)
+        offsets[block + (Ellipsis, 1)] = (match_cols - ref_cols[:, None]).reshape(block_shape)
+        distances[block] = match_distances.reshape(block_shape)
+    return offsets, distances
+
+
+def _refine_matches(padded_im, patch_size, coarse_offsets, refine_dist, num_matches, n_components):
+    '''Refines the matches of the coarser level around their doubled offsets.
+
+    The candidates are first ranked by the distance between their PCA projections, and
+    only the 2 * num_matches closest of them are compared in full.
+
+    Args:
+        padded_im (np.ndarray): The (B, n, m) stack of padded images of this level.
+        patch_size (int): The size of patches to consider.
+        coarse_offsets (np.ndarray): The (B, n // 2, m // 2, K, 2) offsets of the coarser level.
+        refine_dist (int): The distance searched around every inherited offset.
+        num_matches (int): The number of matches kept for every patch.
+        n_components (int): The number of dimensions of the projections.
+
+    Returns:
+        offsets (np.ndarray): The (B, n, m, num_matches, 2) offsets of the matches, closest first.
+        distances (np.ndarray): The (B, n, m, num_matches) distances of the matches.
+    '''
+    pad = patch_size // 2
+    num_images, n, m = padded_im.shape
+    n, m = n - 2 * pad, m - 2 * pad
+    coarse_n, coarse_m = coarse_offsets.shape[1:3]
+    patches = np.lib.stride_tricks.sliding_window_view(padded_im, (patch_size, patch_size), axis=(-2, -1))
+    flat_patches = patches.reshape(num_images, n, m, patch_size * patch_size)
+    features = flat_patches @ pca_components(flat_patches, n_components).astype(padded_im.dtype)
+
+    # Every inherited offset is tried with each local refinement, after the patch itself
+    steps = np.arange(-refine_dist, refine_dist + 1)
+    refinements = np.stack(np.meshgrid(steps, steps, indexing='ij'), axis=-1).reshape(-1, 2)
+    num_candidates = 1 + coarse_offsets.shape[3] * len(refinements)
+    num_ranked = min(2 * num_matches, num_candidates)
+
+    shape = (num_images, n, m, min(num_matches, num_candidates))
+    offsets = np.zeros(shape + (2,), dtype=np.int32)
+    distances = np.empty(shape, dtype=padded_im.dtype)
+
+    # Patches and projections are gathered through flat indices, which is much faster than a 3D fancy index
+    flat_patches = flat_patches.reshape(-1, patch_size * patch_size)
+    features = features.reshape(-1, features.shape[-1])
+    earlier = np.tri(num_ranked, k=-1, dtype=bool)
+
+    image_offsets = (np.arange(num_images) * n * m)[:, None, None, None]
+    cols = np.arange(m)
+    coarse_cols = np.minimum(cols // 2, coarse_m - 1)
+    block_rows = max(1, _BLOCK_ELEMENTS // (num_images * m * (num_candidates * features.shape[-1] + num_ranked * patch_size**2)))
+    for start in range(0, n, block_rows):
+        rows = np.arange(start, min(start + block_rows, n))
+        inherited = 2 * coarse_offsets[:, np.minimum(rows // 2, coarse_n - 1)[:, None], coarse_cols]
+        candidates = (inherited[:, :, :, :, None, :] + refinements).reshape(num_images, len(rows), m, -1, 2)
+        candidates = np.concatenate([np.zeros(candidates.shape[:3] + (1, 2), dtype=candidates.dtype), candidates], axis=3)
+
+        match_rows = rows[:, None, None] + candidates[..., 0]
+        match_cols = cols[:, None] + candidates[..., 1]
+        inside = (match_rows >= 0) & (match_rows < n) & (match_cols >= 0) & (match_cols < m)
+        match_flat = image_offsets + np.clip(match_rows, 0, n - 1) * m + np.clip(match_cols, 0, m - 1)
+        ref_flat = image_offsets[..., 0] + rows[:, None] * m + cols
+        projected = np.sum(np.square(features[match_flat] - features[ref_flat][:, :, :, None]), axis=-1)
+        projected[~inside] = np.inf
+
+        # Only the closest projections are compared in full, in their original order so the patch itself wins ties
+        ranked = np.sort(np.argpartition(projected, num_ranked - 1, axis=-1)[..., :num_ranked], axis=-1)
+        candidates = np.take_along_axis(candidates, ranked[..., None], axis=3)
+        cand_patches = flat_patches[np.take_along_axis(match_flat, ranked, axis=-1)]
+        cand_distances = np.sqrt(np.sum(np.square(cand_patches - flat_patches[ref_flat][:, :, :, None]), axis=-1))
+        cand_distances[~np.isfinite(np.take_along_axis(projected, ranked, axis=-1))] = np.inf
+
+        # Refinements of nearby offsets overlap, so only the first copy of a candidate is kept
+        codes = candidates[..., 0] * (2 * m + 1) + candidates[..., 1]
+        cand_distances[np.any((codes[..., :, None] == codes[..., None, :]) & earlier, axis=-1)] = np.inf
+
+        nearest = np.argsort(cand_distances, axis=-1, kind='stable')[..., :shape[-1]]
+        offsets[:, rows] = np.take_along_axis(candidates, nearest[..., None], axis=3)
+        distances[:, rows] = np.take_along_axis(cand_distances, nearest, axis=-1)
+    return offsets, distances
+
+
+def pyramid_wnnm_filter(im, patch_size, var, levels=3, search_dist=10, refine_dist=1, group_size=10, max_distance=1.75,
+                        dtype=np.float64, instrument=None, **kwargs):
+    '''WNNM filter whose patch groups are found coarse to fine (see pyramid_matches).
+
+    Args:
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
+        patch_size (int): The size of patches to consider.
+        var (float): The variance of the noise on the image.
+        levels (int): The number of pyramid levels.
+        search_dist (int): The distance searched on the coarsest level.
+        refine_dist (int): The distance searched around every inherited offset on the finer levels.
+        group_size (int): The maximum number of similar patches in a group.
+        max_distance (float): The largest distance between a reference patch and its matches.
+        dtype (np.dtype): The floating point type the filter computes in.
+        instrument (Instrumentation): If given, times the pyramid matching and collects the
+            timers and counters of the filter.
+        **kwargs: Extra arguments of non_local_wnnm_filter, e.g. stride or temperature.
+
+    Returns:
+        clean_im (np.ndarray): The filtered image (or stack of images).
+    '''
+    pad = patch_size // 2
+    images = np.asarray(im, dtype=dtype).reshape((-1,) + im.shape[-2:])
+    with timed(instrument, 'pyramid_matching'):
+        offsets, distances = pyramid_matches(images, patch_size, levels, search_dist, group_size, refine_dist)
+
+    rows = np.arange(images.shape[-2])[:, None, None] + pad
+    cols = np.arange(images.shape[-1])[:, None] + pad
+    matches = {'rows': (rows + offsets[..., 0]).astype(np.int32),
+               'cols': (cols + offsets[..., 1]).astype(np.int32),
+               'distances': distances.astype(np.float32),
+               'sizes': np.sum(distances <= max_distance, axis=-1, dtype=np.int32),
+               'stride': 1}
+
+    # The filter reads as far as the farthest match, which sets the halo of its tiles
+    used = np.arange(offsets.shape[-2]) < matches['sizes'][..., None]
+    halo = int(np.abs(offsets[used]).max())
+    clean_im = non_local_wnnm_filter(images, patch_size, halo, var, group_size=group_size, max_distance=max_distance, dtype=dtype,
+                                     matches=matches, instrument=instrument, **kwargs)
+    return clean_im.reshape(im.shape)
+
+
+def pyramid_nlm_filter(im, patch_size, h, levels=3, search_dist=10, refine_dist=1, num_matches=16, dtype=np.float64, instrument=None):
+    '''Non-Local Means filter that averages over the closest patches found coarse to fine
+       (see pyramid_matches), instead of over the whole search window.
+
+    Args:
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
+        patch_size (int): The size of patches to consider.
+        h (float): A constant used to calculate distance between patches.
+        levels (int): The number of pyramid levels.
+        search_dist (int): The distance searched on the coarsest level.
+        refine_dist (int): The distance searched around every inherited offset on the finer levels.
+        num_matches (int): The number of patches each pixel is averaged over.
+        dtype (np.dtype): The floating point type the filter computes in.
+        instrument (Instrumentation): If given, times the pyramid matching and the averaging.
+
+    Returns:
+        clean_im (np.ndarray): The filtered image (or stack of images).
+    '''
+    images = np.asarray(im, dtype=dtype).reshape((-1,) + im.shape[-2:])
+    num_images, n, m = images.shape
+    with timed(instrument, 'pyramid_matching'):
+        offsets, distances = pyramid_matches(images, patch_size, levels, search_dist, num_matches + 1, refine_dist)
+
+    with timed(instrument, 'aggregation'):
+        # Like the single-scale filter, a pixel is averaged over the other patches only
+        offsets, distances = offsets[..., 1:, :], distances[..., 1:]
+        weight = np.exp(-distances / h)
+        match_rows = np.clip(np.arange(n)[:, None, None] + offsets[..., 0], 0, n - 1)
+        match_cols = np.clip(np.arange(m)[:, None] + offsets[..., 1], 0, m - 1)
+        values = images[np.arange(num_images)[:, None, None, None], match_rows, match_cols]
+        total_sum = np.sum(weight, axis=-1)
+        clean_im = np.where(total_sum > 0, np.sum(weight * values, axis=-1) / np.maximum(total_sum, np.finfo(dtype).tiny), images)
+    return clean_im.reshape(im.shape)
@@ -1,52 +1,93 @@
 '''Non-Local Means Filter. '''
 import numpy as np
 
+from filters.instrumentation import count, timed
+from filters.patch_utils import pad_images, search_offsets, shifted_patch_distances
+from filters.tiling import get_tiles, map_tiles
 
-def non_local_means_filter(im, patch_size, search_dist, h):
+
+def non_local_means_filter(im, patch_size, search_dist, h, search_stride=1, tile_size=None, max_workers=1, dtype=np.float64,
+                           instrument=None):
     '''Non-Local Means (NLM) filter.
 
+    Rather than visiting every pixel, the filter sweeps over the search offsets and
+    compares every patch with its shifted counterpart at once, for every image of a stack.
+
     Args:
-        im (np.ndarray): The noisy image to be filtered.
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
         patch_size (int): The size of patches to consider.
         search_dist (int): The distance from the center pixel of a patch to look.
         h (float): A constant used to calculate distance between patches.
+        search_stride (int): The step between the compared patches in the search window.
+            A stride of s compares about s**2 times fewer patches, while every pixel is
+            still filtered.
+        tile_size (int): The side length of the tiles the image is split into. If None,
+            the image is processed as a single tile.
+        max_workers (int): The number of processes the tiles are spread over. If None,
+            uses every CPU.
+        dtype (np.dtype): The floating point type the filter computes in, e.g. np.float32
+            to halve the memory traffic.
+        instrument (Instrumentation): If given, collects the timers and counters of each stage.
 
     Returns:
-        clean_im (np.ndarray): The filtered image.
+        clean_im (np.ndarray): The filtered image (or stack of images).
     '''
 
     pad = patch_size // 2
-    padded_im = np.pad(im, (pad, pad), mode='reflect')
-    n, m = padded_im.shape
+    padded_im = pad_images(np.asarray(im, dtype=dtype), pad)
+
+    clean_im = np.zeros(im.shape, dtype=dtype)
+
+    tiles = get_tiles(padded_im.shape, pad, tile_size, pad + search_dist)
+    results = map_tiles(_non_local_means, padded_im, tiles, max_workers, pad, search_dist, h, search_stride,
+                        instrument=instrument)
+    for (region, _), clean_tile in zip(tiles, results):
+        rows, cols = region
+        clean_im[..., rows.start - pad:rows.stop - pad, cols.start - pad:cols.stop - pad] = clean_tile
+
+    return clean_im
+
 
-    clean_im = np.zeros(im.shape)
+def _non_local_means(padded_im, region, pad, search_dist, h, search_stride=1, instrument=None):
+    '''Applies the NLM filter to the patch centers in a region of a padded image.
 
-    for row in range(pad, n - pad):
-        print(f'Starting iteration {row-pad}/{n-pad*2}.')
-        for col in range(pad, m - pad):
-            curr_patch = padded_im[row - pad:row + pad + 1, col - pad:col + pad + 1]
-            total_sum = 0
+    Args:
+        padded_im (np.ndarray): The padded image, or a (B, n, m) stack of them.
+        region (tuple): The (row, col) slices of the padded image holding the patch centers to filter.
+        pad (int): The padding added to the image (half the patch size).
+        search_dist (int): The distance from the center pixel of a patch to look.
+        h (float): A constant used to calculate distance between patches.
+        search_stride (int): The step between the compared patches in the search window.
+        instrument (Instrumentation): If given, collects the timers and counters of each stage.
 
-            for s_row in range(row - search_dist, row + search_dist + 1):
-                if s_row - pad < 0:
-                    continue
-                elif s_row + pad >= n:
-                    break
+    Returns:
+        clean_region (np.ndarray): The filtered pixels of the region.
+    '''
 
-                for s_col in range(col - search_dist, col + search_dist + 1):
-                    if s_col - pad < 0 or (s_row == row and s_col == col):
-                        continue
-                    elif s_col + pad >= m:
-                        break
+    rows, cols = region
+    clean_region = np.zeros(padded_im.shape[:-2] + (rows.stop - rows.start, cols.stop - cols.start), dtype=padded_im.dtype)
+    total_sum = np.zeros_like(clean_region)
 
-                    search_patch = padded_im[s_row - pad:s_row + pad + 1, s_col - pad:s_col + pad + 1]
+    for d_row, d_col in search_offsets(search_dist, search_stride):
+        if d_row == 0 and d_col == 0:
+            continue
 
-                    euclideanDistance = np.sqrt(np.sum(np.square(curr_patch - search_patch)))
-                    weight = np.exp(-euclideanDistance / h)
-                    total_sum += weight
+        with timed(instrument, 'patch_distances'):
+            ssd, (c_rows, c_cols) = shifted_patch_distances(padded_im, pad, d_row, d_col, region)
+        if ssd.size == 0:
+            continue
+        count(instrument, 'offsets')
 
-                    clean_im[row - pad, col - pad] += weight * padded_im[s_row, s_col]
+        with timed(instrument, 'aggregation'):
+            weight = np.exp(-np.sqrt(ssd) / h)
+            out_rows = slice(c_rows.start - rows.start, c_rows.stop - rows.start)
+            out_cols = slice(c_cols.start - cols.start, c_cols.stop - cols.start)
+            search_rows = slice(c_rows.start + d_row, c_rows.stop + d_row)
+            search_cols = slice(c_cols.start + d_col, c_cols.stop + d_col)
 
-            clean_im[row - pad, col - pad] /= total_sum
+            total_sum[..., out_rows, out_cols] += weight
+            clean_region[..., out_rows, out_cols] += weight * padded_im[..., search_rows, search_cols]
 
-    return clean_im
+    clean_region /= total_sum
+
+    return clean_region
@@ -1,156 +1,343 @@
 '''Non-Local Weighted Nuclear Norm Minimization (WNNM) Filter. '''
 import numpy as np
 
+from filters.block_matching import similar_patches
+from filters.instrumentation import count, progress, timed
+from filters.patch_utils import pad_images, reference_centers, strided_indices
+from filters.tiling import get_tiles, map_tiles
 
-def non_local_wnnm_filter(im, patch_size, search_dist, var):
+_BLOCK_PIXELS = 4096
+
+
+def non_local_wnnm_filter(im, patch_size, search_dist, var, stride=1, group_size=10, max_distance=1.75, temperature=0.1,
+                          tile_size=None, max_workers=1, dtype=np.float64, index=None, matches=None, return_matches=False,
+                          instrument=None):
     '''Non-Local Weighted Nuclear Norm Minimization (WNNM) filter.
 
+    The reference patches are processed in blocks of rows. Each block is matched against
+    its search window with one vectorized sweep per offset, and all of its patch groups
+    of the same size are cleaned with a single batched SVD. A stack of images is handled
+    by running the blocks over every image of the stack at once.
+
+    Block matching dominates the cost, so its result can be returned and passed back in
+    to reuse the same patch groups on another image of the same shape, such as the next
+    outer iteration of iterative regularization.
+
     Args:
-        im (np.ndarray): The noisy image to be filtered.
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
         patch_size (int): The size of patches to consider.
         search_dist (int): The distance from the center pixel of a patch to look.
         var (float): The variance of the noise on the image.
+        stride (int): The step between reference patches, at most patch_size so that every
+            pixel is still covered. The last row and col of patches are always references,
+            and a stride of s cuts the number of groups by about s**2.
+        group_size (int): The maximum number of similar patches in a group, at least 1.
+        max_distance (float): The largest distance between a reference patch and its matches.
+        temperature (float): The temperature of the weights a cleaned patch is aggregated with,
+            exp(-distance / temperature), where the distance is to the noisy reference patch.
+        tile_size (int): The side length of the tiles the image is split into. If None,
+            the image is processed as a single tile.
+        max_workers (int): The number of processes the tiles are spread over. If None,
+            uses every CPU.
+        dtype (np.dtype): The floating point type the filter computes in, including the SVDs.
+        index (PatchIndex): If given, similar patches are found approximately through this
+            index, within its own search distance, instead of by an exact search of the
+            search_dist window. When tiled, the index only sees each tile and its halo.
+        matches (dict): If given, the block matching result of a previous call with the same
+            patch size, whose patch groups are reused instead of searching again. Its stride
+            must divide this call's stride, so that every reference patch has a group.
+            When tiled, the halo of the tiles grows to reach the farthest reused match, so
+            matches found by a global index make every tile read most of the image.
+        return_matches (bool): Whether to also return the block matching result.
+        instrument (Instrumentation): If given, collects the timers and counters of block
+            matching, SVD, shrinkage and aggregation.
 
     Returns:
-        clean_im (np.ndarray): The filtered image.
+        clean_im (np.ndarray): The filtered image (or stack of images).
+        matches (dict): The block matching result, only returned if return_matches is True.
+            For every patch center of every image, it holds the padded image rows and cols
+            of the similar patches (int32), their distances to the reference patch
+            (float32), and the number of valid patches in the group (int32), which is 0 for
+            the centers skipped by the stride. It also records that stride.
+
+    Raises:
+        ValueError: If the stride or group size is out of range, or the matches are for
+            images of another shape or lack the groups of some reference patches.
     '''
 
+    if not 1 <= stride <= patch_size:
+        raise ValueError(f'The stride must be between 1 and the patch size ({patch_size}), not {stride}')
+    if group_size < 1:
+        raise ValueError(f'The group size must be at least 1, not {group_size}')
+
     pad = patch_size // 2
-    padded_im = np.pad(im, (pad, pad), mode='reflect')
-    n, m = padded_im.shape
-
-    clean_padded_im = np.zeros(padded_im.shape)
-    count_padded_im = np.zeros(padded_im.shape)
-
-    for row in range(pad, n - pad):
-        print(f'Starting iteration {row-pad}/{n-pad*2}.')
-        for col in range(pad, m - pad):
-            curr_patch = padded_im[row - pad:row + pad + 1, col - pad:col + pad + 1]
-            similar_patches, patch_locations = _get_similar_patches(padded_im, patch_size, search_dist, row, col)
-            clean_patches = _compute_wnnm(similar_patches, var)
-            im_update, count_update = _collapse_stacked_patches(padded_im.shape, curr_patch, clean_patches, patch_locations)
-            clean_padded_im += im_update
-            count_padded_im += count_update
+    images = np.asarray(im, dtype=dtype).reshape((-1,) + im.shape[-2:])
+    if matches is not None and matches['sizes'].shape != images.shape:
+        raise ValueError(f'The block matches are for images of shape {matches["sizes"].shape}, not {images.shape}')
+    if matches is not None and stride % matches['stride'] != 0:
+        raise ValueError(f'The block matches of stride {matches["stride"]} lack the groups of stride {stride}')
+    padded_im = pad_images(images, pad)
+
+    clean_padded_im = np.zeros_like(padded_im)
+    count_padded_im = np.zeros_like(padded_im)
+
+    # The grid of reference patches spans the whole image, so it does not depend on the tiling
+    ref_rows = strided_indices(slice(pad, padded_im.shape[-2] - pad), stride)
+    ref_cols = strided_indices(slice(pad, padded_im.shape[-1] - pad), stride)
+
+    halo = pad + search_dist
+    if matches is not None:
+        halo = max(halo, pad + _match_reach(matches, pad))
+    tiles = get_tiles(padded_im.shape, pad, tile_size, halo)
+    tile_args = []
+    for region, window in tiles:
+        centers = tuple(indices[(indices >= r.start) & (indices < r.stop)] - w.start for indices, r, w in zip((ref_rows, ref_cols), region, window))
+        tile_args.append((centers, None if matches is None else _tile_matches(matches, region, window, pad)))
+    results = map_tiles(_accumulate_wnnm, padded_im, tiles, max_workers, patch_size, search_dist, var, index, group_size,
+                        max_distance, temperature, tile_args=tile_args, instrument=instrument)
+
+    new_matches = None
+    for (region, window), (clean_tile, count_tile, tile_matches) in zip(tiles, results):
+        clean_padded_im[(Ellipsis,) + window] += clean_tile
+        count_padded_im[(Ellipsis,) + window] += count_tile
+        if return_matches:
+            if new_matches is None:
+                match_shape = images.shape + tile_matches['rows'].shape[-1:]
+                new_matches = {'rows': np.empty(match_shape, dtype=np.int32),
+                               'cols': np.empty(match_shape, dtype=np.int32),
+                               'distances': np.empty(match_shape, dtype=np.float32),
+                               'sizes': np.empty(images.shape, dtype=np.int32),
+                               'stride': stride}
+            centers = (slice(None), slice(region[0].start - pad, region[0].stop - pad), slice(region[1].start - pad, region[1].stop - pad))
+            new_matches['rows'][centers] = tile_matches['rows'] + window[0].start
+            new_matches['cols'][centers] = tile_matches['cols'] + window[1].start
+            new_matches['distances'][centers] = tile_matches['distances']
+            new_matches['sizes'][centers] = tile_matches['sizes']
 
     clean_padded_im /= count_padded_im
-    clean_im = clean_padded_im[pad:-pad, pad:-pad]
+    clean_im = clean_padded_im[:, pad:-pad, pad:-pad].reshape(im.shape)
 
+    if return_matches:
+        return clean_im, new_matches
     return clean_im
 
 
-def _get_similar_patches(padded_im, patch_size, search_dist, row, col):
-    '''Takes in a patch and returns all similar patches.
+def _match_reach(matches, pad):
+    '''Finds the largest row or col distance between a reference patch and its valid matches.
 
     Args:
-        padded_im (np.ndarray): The padded image.
-        patch_size (int): The size of patches to consider.
-        search_dist (int): The distance from the center pixel of a patch to look.
-        row (int): The row of the pixel being currently considered.
-        col (int): The col of the pixel being currently considered.
+        matches (dict): The block matching result of the whole (stack of) images.
+        pad (int): The padding added to the image (half the patch size).
 
     Returns:
-        similar_patches (np.ndarray): The vertically stacked similar patches.
-        patch_locations (list): The location of the patches.
+        reach (int): The largest distance, 0 if there are no matches.
     '''
+    valid = np.arange(matches['rows'].shape[-1]) < matches['sizes'][..., None]
+    if not valid.any():
+        return 0
+    num_images, n, m = matches['sizes'].shape
+    center_rows = np.arange(pad, n + pad)[:, None, None]
+    center_cols = np.arange(pad, m + pad)[None, :, None]
+    return int(max(np.abs(matches['rows'] - center_rows)[valid].max(), np.abs(matches['cols'] - center_cols)[valid].max()))
 
-    pad = patch_size // 2
-    n, m = padded_im.shape[0] - pad, padded_im.shape[1] - pad
-    curr_patch = padded_im[row - pad:row + pad + 1, col - pad:col + pad + 1]
 
-    all_patches = [(0, (row, col), curr_patch)]
+def _tile_matches(matches, region, window, pad):
+    '''Extracts the block matching result of a tile, in the coordinates of its window.
 
-    for s_row in range(row - search_dist, row + search_dist + 1):
-        if s_row - pad < 0:
-            continue
-        elif s_row + pad >= n:
-            break
+    Args:
+        matches (dict): The block matching result of the whole (stack of) images.
+        region (tuple): The (row, col) slices of the padded image holding the tile's patch centers.
+        window (tuple): The (row, col) slices of the padded image read by the tile.
+        pad (int): The padding added to the image (half the patch size).
+
+    Returns:
+        tile_matches (dict): The block matching result of the tile's patch centers.
 
-        for s_col in range(col - search_dist, col + search_dist + 1):
-            if s_col - pad < 0 or (s_row == row and s_col == col):
-                continue
-            elif s_col + pad >= m:
-                break
+    Raises:
+        ValueError: If a matched patch does not lie inside the tile's window.
+    '''
+    centers = (slice(None), slice(region[0].start - pad, region[0].stop - pad), slice(region[1].start - pad, region[1].stop - pad))
+    tile_matches = {'rows': matches['rows'][centers] - window[0].start,
+                    'cols': matches['cols'][centers] - window[1].start,
+                    'distances': matches['distances'][centers],
+                    'sizes': matches['sizes'][centers]}
 
-            search_patch = padded_im[s_row - pad:s_row + pad + 1, s_col - pad:s_col + pad + 1]
-            euclideanDistance = np.sqrt(np.sum(np.square(curr_patch - search_patch)))
-            if euclideanDistance <= 1.75:
-                all_patches.append((euclideanDistance, (s_row, s_col), search_patch))
+    valid = np.arange(tile_matches['rows'].shape[-1]) < tile_matches['sizes'][..., None]
+    rows, cols = tile_matches['rows'][valid], tile_matches['cols'][valid]
+    window_rows, window_cols = window[0].stop - window[0].start, window[1].stop - window[1].start
+    if np.any((rows < pad) | (rows >= window_rows - pad) | (cols < pad) | (cols >= window_cols - pad)):
+        raise ValueError('The reused block matches reach outside the tile window; pass tile_size=None to reuse them')
+    return tile_matches
 
-    all_patches.sort()
-    similar_patches = np.vstack([item[2] for item in all_patches[0:min(len(all_patches), 10)]])
-    patch_locations = [item[1] for item in all_patches[0:min(len(all_patches), 10)]]
-    return similar_patches, patch_locations
 
+def _accumulate_wnnm(padded_im, region, patch_size, search_dist, var, index, group_size, max_distance, temperature, centers,
+                     matches=None, instrument=None):
+    '''Cleans the patch group of every reference patch centered in a region of a stack of padded images.
 
-def _compute_wnnm(stacked_patches, var):
+    Args:
+        padded_im (np.ndarray): The (B, n, m) stack of padded images.
+        region (tuple): The (row, col) slices of the padded images holding the reference patch centers.
+        patch_size (int): The size of patches to consider.
+        search_dist (int): The distance from the center pixel of a patch to look.
+        var (float): The variance of the noise on the image.
+        index (PatchIndex): The approximate index used for block matching, or None for an exact search.
+        group_size (int): The maximum number of patches in a group.
+        max_distance (float): The largest distance between a reference patch and its matches.
+        temperature (float): The temperature of the aggregation weights.
+        centers (tuple): The row and col indices of the reference patch centers, all within the region.
+        matches (dict): If given, the block matching result of the region to reuse.
+        instrument (Instrumentation): If given, collects the timers and counters of each stage.
+
+    Returns:
+        clean_padded_im (np.ndarray): The sum of the weighted clean patches over the padded images.
+        count_padded_im (np.ndarray): The sum of the patch weights over the padded images.
+        matches (dict): The block matching result of the region.
+    '''
+
+    pad = patch_size // 2
+    num_images, n, m = padded_im.shape
+    rows, cols = region
+    patches = np.lib.stride_tricks.sliding_window_view(padded_im, (patch_size, patch_size), axis=(-2, -1))
+
+    clean_padded_im = np.zeros_like(padded_im)
+    count_padded_im = np.zeros_like(padded_im)
+    patch_offsets = (np.arange(patch_size)[:, None] * m + np.arange(patch_size)).ravel()
+    if index is not None and matches is None:
+        with timed(instrument, 'index_build'):
+            trees = index.build(patches)
+
+    if matches is None:
+        # Groups never hold more patches than there are search offsets
+        region_shape = (num_images, rows.stop - rows.start, cols.stop - cols.start)
+        max_group_size = group_size if index is not None else min(group_size, (2 * search_dist + 1)**2)
+        new_matches = {'rows': np.zeros(region_shape + (max_group_size,), dtype=np.int32),
+                       'cols': np.zeros(region_shape + (max_group_size,), dtype=np.int32),
+                       'distances': np.full(region_shape + (max_group_size,), np.inf, dtype=np.float32),
+                       'sizes': np.zeros(region_shape, dtype=np.int32)}
+
+    ref_row_indices, ref_col_indices = centers
+    col_positions = ref_col_indices - cols.start
+
+    block_rows = max(1, _BLOCK_PIXELS // (num_images * max(len(ref_col_indices), 1)))
+    num_blocks = -(-len(ref_row_indices) // block_rows)
+    for block_idx, start in enumerate(range(0, len(ref_row_indices) if len(ref_col_indices) else 0, block_rows)):
+        centers = (ref_row_indices[start:start + block_rows], ref_col_indices)
+        block_centers = (slice(None), centers[0][:, None] - rows.start, col_positions)
+        if matches is None:
+            with timed(instrument, 'block_matching'):
+                if index is None:
+                    block_matches = similar_patches(padded_im, patch_size, search_dist, centers, group_size, max_distance)
+                else:
+                    block_matches = index.similar_patches(trees, patches, centers, group_size, max_distance)
+                ref_images, ref_rows, ref_cols, match_rows, match_cols, match_distances, group_sizes = block_matches
+            _store_block_matches(new_matches, block_centers, match_rows, match_cols, match_distances, group_sizes)
+        else:
+            ref_images, ref_rows, ref_cols = reference_centers(num_images, centers)
+            match_rows = matches['rows'][block_centers].reshape(len(ref_rows), -1)
+            match_cols = matches['cols'][block_centers].reshape(len(ref_rows), -1)
+            group_sizes = matches['sizes'][block_centers].ravel()
+            count(instrument, 'reused_blocks')
+        count(instrument, 'reference_patches', len(ref_rows))
+
+        for size in np.unique(group_sizes[group_sizes > 0]):
+            members = np.flatnonzero(group_sizes == size)
+            group_images = ref_images[members, None]
+            group_rows = match_rows[members, :size]
+            group_cols = match_cols[members, :size]
+            group_patches = patches[group_images, group_rows - pad, group_cols - pad].reshape(len(members), size * patch_size, patch_size)
+            clean_patches = _compute_wnnm(group_patches, var, instrument)
+            count(instrument, 'svd_batches')
+
+            with timed(instrument, 'aggregation'):
+                curr_patches = patches[ref_images[members], ref_rows[members] - pad, ref_cols[members] - pad]
+                corners = (group_images * n + group_rows - pad) * m + (group_cols - pad)
+                _collapse_stacked_patches(clean_padded_im, count_padded_im, curr_patches, clean_patches, corners, patch_offsets, temperature)
+
+        progress(instrument, 'blocks', block_idx + 1, num_blocks)
+
+    return clean_padded_im, count_padded_im, (new_matches if matches is None else matches)
+
+
+def _store_block_matches(matches, block_centers, match_rows, match_cols, match_distances, group_sizes):
+    '''Copies the block matching result of a block into the compact arrays of its region.
+
+    Args:
+        matches (dict): The block matching result of the region, updated in place.
+        block_centers (tuple): The (image, row, col) index of the block's reference patches within the region.
+        match_rows (np.ndarray): The rows of the similar patches, one row per reference.
+        match_cols (np.ndarray): The cols of the similar patches, one row per reference.
+        match_distances (np.ndarray): The distances of the similar patches, one row per reference.
+        group_sizes (np.ndarray): The number of valid similar patches for each reference.
+    '''
+    sizes = matches['sizes'][block_centers]
+    group_size = match_rows.shape[1]
+    matches['rows'][block_centers + (slice(group_size),)] = match_rows.reshape(sizes.shape + (group_size,))
+    matches['cols'][block_centers + (slice(group_size),)] = match_cols.reshape(sizes.shape + (group_size,))
+    matches['distances'][block_centers + (slice(group_size),)] = match_distances.reshape(sizes.shape + (group_size,))
+    matches['sizes'][block_centers] = group_sizes.reshape(sizes.shape)
+
+
+def _compute_wnnm(stacked_patches, var, instrument=None):
     '''Given the stacked patches, calculates the minimum nuclear norm representation of the stack.
 
     Args:
-        stacked_patches (np.ndarray): The vertically stacked similar patches.
+        stacked_patches (np.ndarray): The vertically stacked similar patches, optionally
+            with leading batch dimensions.
         var (float): The variance of the Gaussian noise that has been added.
+        instrument (Instrumentation): If given, times the SVD and the shrinkage.
 
     Returns:
         clean_patches (np.ndarray): The vertically stacked 'clean' patches.
     '''
 
-    u, sigmas_y, vh = np.linalg.svd(stacked_patches, full_matrices=True)
-    sigmas_x = np.zeros(sigmas_y.shape[0])
-
-    for i in range(sigmas_y.shape[0]):
-        sigma_yi = sigmas_y[i]
-        w_i = _estimate_weight(stacked_patches, var, sigma_yi)
-        sigma_wi = max(sigma_yi - w_i, 0)
-        sigmas_x[i] = sigma_wi
-
-    Sigma_X = np.diag(sigmas_x)
-    Sigma_X = np.vstack((Sigma_X, np.zeros((u.shape[0] - Sigma_X.shape[0], Sigma_X.shape[1]))))
-    clean_patches = u @ Sigma_X @ vh
+    with timed(instrument, 'svd'):
+        u, sigmas_y, vh = np.linalg.svd(stacked_patches, full_matrices=False)
+    with timed(instrument, 'shrinkage'):
+        n = stacked_patches.shape[-2] // stacked_patches.shape[-1]
+        sigmas_x = np.maximum(sigmas_y - _estimate_weight(sigmas_y, n, var), 0)
+        clean_patches = (u * sigmas_x[..., None, :]) @ vh
     return clean_patches
 
 
-def _estimate_weight(stacked_patches, var, sigma_yi):
-    '''Calculates the weight necessary for the NNM process.
+def _estimate_weight(sigmas_y, n, var):
+    '''Calculates the weights necessary for the NNM process.
 
     Args:
-        stacked_patches (np.ndarray): The vertically stacked similar patches.
+        sigmas_y (np.ndarray): The singular values of the stacked patches.
+        n (int): The number of patches in each stack.
         var (float): The variance of the Gaussian noise that has been added.
-        sigma_yi (float): The ith singular value of stacked_patches.
 
     Returns:
-        w_i (weight): The weight of the ith singular value of this WNNM.
+        w (np.ndarray): The weight of each singular value of this WNNM.
     '''
-    n = stacked_patches.shape[0] // stacked_patches.shape[1]
     eps = 0.00001
-    sigma_xi = np.sqrt(max(sigma_yi**2 - n * var, 0))
-    w_i = (2 * n)**0.5 / (sigma_xi + eps)
-    return w_i
+    sigmas_x = np.sqrt(np.maximum(sigmas_y**2 - n * var, 0))
+    w = (2 * n)**0.5 / (sigmas_x + eps)
+    return w
 
 
-def _collapse_stacked_patches(padded_im_shape, curr_patch, clean_patches, patch_locations):
-    '''Using the cleaned patches, calculate the final clean patch.
+def _collapse_stacked_patches(clean_padded_im, count_padded_im, curr_patches, clean_patches, corners, patch_offsets, temperature):
+    '''Adds a block of cleaned patch groups, weighted by their similarity to the reference
+       patch, into the image accumulators in place.
 
     Args:
-        padded_im_shape (tuple): The shape of the padded image.
-        curr_patch (np.ndarray): The current (noisy) patch being considered.
-        clean_patches (np.ndarray): The vertically stacked clean similar patches.
-        patch_locations (list): The location of the patches.
-
-    Results:
-        clean_patch (np.ndarray): The cleaned patch being considered.
+        clean_padded_im (np.ndarray): The accumulator of weighted clean pixels.
+        count_padded_im (np.ndarray): The accumulator of weights.
+        curr_patches (np.ndarray): The current (noisy) reference patch of each group.
+        clean_patches (np.ndarray): The vertically stacked clean similar patches of each group.
+        corners (np.ndarray): The flat index in the padded image of the top-left pixel of each clean patch.
+        patch_offsets (np.ndarray): The flat index of every pixel in a patch relative to its top-left pixel.
+        temperature (float): The temperature of the weights.
     '''
 
-    patch_size = clean_patches.shape[1]
-    n = clean_patches.shape[0] // patch_size
-    pad = clean_patches.shape[1] // 2
-    updated_im = np.zeros(padded_im_shape)
-    updated_count = np.zeros(padded_im_shape)
-
-    for patch in range(n):
-        clean_patch = clean_patches[patch:patch + patch_size, :]
-        euclideanDistance = np.sqrt(np.sum(np.square(curr_patch - clean_patch)))
-        weight = np.exp(-euclideanDistance / 0.1)
-        s_row, s_col = patch_locations[patch]
-        updated_im[s_row - pad:s_row + pad + 1, s_col - pad:s_col + pad + 1] += weight * clean_patch
-        updated_count[s_row - pad:s_row + pad + 1, s_col - pad:s_col + pad + 1] += weight * np.ones((patch_size, patch_size))
-
-    return updated_im, updated_count
+    num_groups, group_size = corners.shape
+    patch_size = clean_patches.shape[-1]
+    clean_patches = clean_patches.reshape(num_groups, group_size, patch_size, patch_size)
+
+    euclideanDistance = np.sqrt(np.sum(np.square(curr_patches[:, None] - clean_patches), axis=(-2, -1)))
+    weight = np.exp(-euclideanDistance / temperature)
+
+    indices = (corners[:, :, None] + patch_offsets).ravel()
+    weighted_patches = weight[:, :, None] * clean_patches.reshape(num_groups, group_size, -1)
+    np.add.at(clean_padded_im.reshape(-1), indices, weighted_patches.ravel())
+    np.add.at(count_padded_im.reshape(-1), indices, np.repeat(weight.ravel(), patch_size * patch_size))
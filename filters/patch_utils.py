@@ -0,0 +1,164 @@
+'''Shared helpers for the patch-based (non-local) filters. '''
+import numpy as np
+
+
+def box_sum(arr, size, rows=None, cols=None):
+    '''Sums every size x size window over the last two axes of an array using separable
+       running sums, so the cost does not depend on the window size.
+
+    Args:
+        arr (np.ndarray): The (..., n, m) array to be summed.
+        size (int): The side length of the square window.
+        rows (np.ndarray): If given, the increasing first rows of the only windows to sum,
+            which skips the column sums of every other row.
+        cols (np.ndarray): If given, the increasing first cols of the only windows to sum.
+
+    Returns:
+        window_sums (np.ndarray): The sum of every window, of shape (..., n - size + 1, m - size + 1),
+            or of the selected windows, of shape (..., len(rows), len(cols)).
+    '''
+
+    cumulative = np.cumsum(arr, axis=-2)
+    if rows is None:
+        row_sums = cumulative[..., size - 1:, :].copy()
+        row_sums[..., 1:, :] -= cumulative[..., :-size, :]
+    else:
+        row_sums = cumulative[..., rows + size - 1, :]
+        row_sums[..., rows > 0, :] -= cumulative[..., rows[rows > 0] - 1, :]
+
+    cumulative = np.cumsum(row_sums, axis=-1)
+    if cols is None:
+        window_sums = cumulative[..., :, size - 1:].copy()
+        window_sums[..., :, 1:] -= cumulative[..., :, :-size]
+    else:
+        window_sums = cumulative[..., :, cols + size - 1]
+        window_sums[..., :, cols > 0] -= cumulative[..., :, cols[cols > 0] - 1]
+    return window_sums
+
+
+def pad_images(im, pad):
+    '''Reflect-pads the last two axes of an image or a stack of images.
+
+    Args:
+        im (np.ndarray): The (..., n, m) image or stack of images.
+        pad (int): The padding to add on each side.
+
+    Returns:
+        padded_im (np.ndarray): The padded image(s).
+    '''
+    pad_width = [(0, 0)] * (im.ndim - 2) + [(pad, pad)] * 2
+    return np.pad(im, pad_width, mode='reflect')
+
+
+def search_offsets(search_dist, stride=1):
+    '''Lists the (row, col) offsets in the search window, in row-major order.
+
+    Args:
+        search_dist (int): The distance from the center pixel of a patch to look.
+        stride (int): Only offsets that are multiples of stride along both axes are listed.
+
+    Returns:
+        offsets (list): The (d_row, d_col) offsets, including (0, 0).
+    '''
+    steps = range(-(search_dist // stride) * stride, search_dist + 1, stride)
+    return [(d_row, d_col) for d_row in steps for d_col in steps]
+
+
+def strided_indices(centers, stride):
+    '''Picks every stride-th index of a range, always including its last index.
+
+    Args:
+        centers (slice): The range of indices.
+        stride (int): The step between the picked indices.
+
+    Returns:
+        indices (np.ndarray): The picked indices, in increasing order.
+    '''
+    indices = np.arange(centers.start, centers.stop, stride)
+    if len(indices) > 0 and indices[-1] != centers.stop - 1:
+        indices = np.append(indices, centers.stop - 1)
+    return indices
+
+
+def reference_centers(num_images, centers):
+    '''Lists the image, row and col of every patch center on a grid of a stack of images,
+       in (image, row, col) order.
+
+    Args:
+        num_images (int): The number of images in the stack.
+        centers (tuple): The row and col indices of the grid of patch centers.
+
+    Returns:
+        ref_images (np.ndarray): The image of each patch center.
+        ref_rows (np.ndarray): The row of each patch center.
+        ref_cols (np.ndarray): The col of each patch center.
+    '''
+    ref_images, ref_rows, ref_cols = np.meshgrid(np.arange(num_images), *centers, indexing='ij')
+    return ref_images.ravel(), ref_rows.ravel(), ref_cols.ravel()
+
+
+def shifted_patch_distances(padded_im, pad, d_row, d_col, region=None):
+    '''Calculates the sum of squared differences between every patch and the patch
+       offset from it by (d_row, d_col), for all patch centers at once.
+
+    Args:
+        padded_im (np.ndarray): The padded image, or a (..., n, m) stack of padded images.
+        pad (int): The padding added to the image (half the patch size).
+        d_row (int): The row offset of the compared patch.
+        d_col (int): The col offset of the compared patch.
+        region (tuple): The (row, col) slices of the padded image holding the patch centers
+            to consider. Defaults to every center.
+
+    Returns:
+        ssd (np.ndarray): The sum of squared differences for each valid patch center (and image).
+        centers (tuple): The (row, col) slices of the padded image containing those centers.
+    '''
+
+    n, m = padded_im.shape[-2:]
+    if region is None:
+        region = (slice(pad, n - pad), slice(pad, m - pad))
+    rows, cols = region
+
+    top, bottom = max(0, -d_row, rows.start - pad), min(n, n - d_row, rows.stop + pad)
+    left, right = max(0, -d_col, cols.start - pad), min(m, m - d_col, cols.stop + pad)
+    centers = (slice(top + pad, bottom - pad), slice(left + pad, right - pad))
+
+    if bottom - top <= 2 * pad or right - left <= 2 * pad:
+        return np.zeros((0, 0)), centers
+
+    diff = padded_im[..., top:bottom, left:right] - padded_im[..., top + d_row:bottom + d_row, left + d_col:right + d_col]
+    ssd = np.maximum(box_sum(np.square(diff), 2 * pad + 1), 0)
+    return ssd, centers
+
+
+def strided_patch_distances(padded_im, pad, d_row, d_col, centers):
+    '''Calculates the sum of squared differences between the patches centered on a grid
+       and the patches offset from them by (d_row, d_col). Only the windows of the grid are
+       summed, so a sparse grid costs less than every center.
+
+    Args:
+        padded_im (np.ndarray): The padded image, or a (..., n, m) stack of padded images.
+        pad (int): The padding added to the image (half the patch size).
+        d_row (int): The row offset of the compared patch.
+        d_col (int): The col offset of the compared patch.
+        centers (tuple): The increasing row and col indices of the patch centers in the padded image.
+
+    Returns:
+        ssd (np.ndarray): The sum of squared differences for each valid patch center (and image).
+        valid (tuple): The (row, col) slices of the center indices whose offset patch lies
+            inside the image.
+    '''
+
+    n, m = padded_im.shape[-2:]
+    row_indices, col_indices = centers
+    rows = slice(*np.searchsorted(row_indices, [pad - d_row, n - pad - d_row]))
+    cols = slice(*np.searchsorted(col_indices, [pad - d_col, m - pad - d_col]))
+    valid_rows, valid_cols = row_indices[rows], col_indices[cols]
+    if len(valid_rows) == 0 or len(valid_cols) == 0:
+        return np.zeros((0, 0)), (rows, cols)
+
+    top, bottom = valid_rows[0] - pad, valid_rows[-1] + pad + 1
+    left, right = valid_cols[0] - pad, valid_cols[-1] + pad + 1
+    diff = padded_im[..., top:bottom, left:right] - padded_im[..., top + d_row:bottom + d_row, left + d_col:right + d_col]
+    ssd = np.maximum(box_sum(np.square(diff), 2 * pad + 1, valid_rows - pad - top, valid_cols - pad - left), 0)
+    return ssd, (rows, cols)
@@ -1,10 +1,51 @@
 '''Quadratic Filter'''
-import cvxpy as cp
+import numpy as np
 
+from filters.instrumentation import timed
+from filters.spectral import solve_screened_poisson
 
-def quadratic_filter(im, lamb=1):
+
+_cvxpy_problems = {}
+
+
+def quadratic_filter(im, lamb=1, backend='spectral', dtype=np.float64, instrument=None):
     '''Quadratic Filter.
 
+    The default 'spectral' backend solves the optimality conditions (I + lamb*L)X = Y
+    directly, where the Laplacian L is diagonalized by the discrete cosine transform.
+    The 'cvxpy' backend solves the original optimization problem with cvxpy, one image
+    of a stack at a time. Its problem is built once per image shape, with the image and
+    lambda as parameters, and warm-started from the previous solution of that shape.
+
+    Args:
+        im (np.ndarray): The noisy image to be filtered, or a (B, n, m) stack of them.
+        lamb (float): The free parameter (lambda) that determines how much to correct.
+        backend (str): The solver to use, either 'spectral' or 'cvxpy'.
+        dtype (np.dtype): The floating point type of the result. The spectral backend also
+            computes in it, while cvxpy always solves in float64.
+        instrument (Instrumentation): If given, times the solve.
+
+    Returns:
+        clean_im (np.ndarray): The filtered image (or stack of images).
+    '''
+
+    if backend not in ('spectral', 'cvxpy'):
+        raise ValueError(f'Unknown quadratic filter backend: {backend}')
+
+    im = np.asarray(im, dtype=dtype)
+    with timed(instrument, 'solve'):
+        if backend == 'spectral':
+            clean_im = solve_screened_poisson(im, lamb)
+        elif im.ndim == 3:
+            clean_im = np.stack([_quadratic_filter_cvxpy(single_im, lamb) for single_im in im])
+        else:
+            clean_im = _quadratic_filter_cvxpy(im, lamb)
+    return clean_im.astype(dtype, copy=False)
+
+
+def _quadratic_filter_cvxpy(im, lamb):
+    '''Quadratic Filter solved with cvxpy.
+
     Args:
         im (np.ndarray): The noisy image to be filtered.
         lamb (float): The free parameter (lambda) that determines how much to correct.
@@ -12,18 +53,39 @@ def quadratic_filter(im, lamb=1):
     Returns:
         clean_im (np.ndarray): The filtered image.
     '''
+    import cvxpy as cp
 
-    X = cp.Variable(im.shape)
-    dXdx = cp.diff(X, k=1, axis=0)
-    dXdy = cp.diff(X, k=1, axis=1)
-    objective = cp.Minimize(cp.sum_squares(X - im) + lamb * cp.sum_squares(dXdx) + lamb * cp.sum_squares(dXdy))
-
-    prob = cp.Problem(objective)
+    prob, X, Y, lamb_param = _cvxpy_problem(im.shape)
+    Y.value = np.asarray(im, dtype=np.float64)
+    lamb_param.value = lamb
     try:
-        prob.solve(verbose=True)
+        prob.solve(warm_start=True, verbose=False)
     except cp.SolverError as e:
-        print('[ERROR] Quadratic Filter Failed.')
-        print(e)
-        exit()
-    clean_im = X.value
+        raise RuntimeError(f'Quadratic filter failed: {e}') from e
+    clean_im = X.value.copy()
     return clean_im
+
+
+def _cvxpy_problem(shape):
+    '''Builds (or reuses) the parametrized quadratic problem of an image shape.
+
+    Args:
+        shape (tuple): The shape of the image.
+
+    Returns:
+        prob (cp.Problem): The problem.
+        X (cp.Variable): The filtered image.
+        Y (cp.Parameter): The noisy image.
+        lamb (cp.Parameter): The free parameter (lambda).
+    '''
+    import cvxpy as cp
+
+    if shape not in _cvxpy_problems:
+        X = cp.Variable(shape)
+        Y = cp.Parameter(shape)
+        lamb = cp.Parameter(nonneg=True)
+        dXdx = cp.diff(X, k=1, axis=0)
+        dXdy = cp.diff(X, k=1, axis=1)
+        objective = cp.Minimize(cp.sum_squares(X - Y) + lamb * cp.sum_squares(dXdx) + lamb * cp.sum_squares(dXdy))
+        _cvxpy_problems[shape] = (cp.Problem(objective), X, Y, lamb)
+    return _cvxpy_problems[shape]
@@ -0,0 +1,76 @@
+'''Spectral solvers for systems involving the image Laplacian. '''
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from scipy import fft
+except ImportError:
+    fft = None
+
+
+@lru_cache(maxsize=16)
+def dct_basis(n):
+    '''Builds the orthonormal DCT-II basis, which diagonalizes the Laplacian of a path
+       of n pixels with reflective (Neumann) boundaries.
+
+    Args:
+        n (int): The number of pixels along the axis.
+
+    Returns:
+        basis (np.ndarray): The (n, n) DCT-II matrix, one basis vector per row. It is cached,
+            so it is read-only.
+        eigenvalues (np.ndarray): The eigenvalues of the Laplacian for each basis vector.
+    '''
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    basis = np.sqrt(2.0 / n) * np.cos(np.pi * k * (2 * i + 1) / (2 * n))
+    basis[0, :] = np.sqrt(1.0 / n)
+    basis.flags.writeable = False
+    return basis, laplacian_eigenvalues(n)
+
+
+def solve_screened_poisson(rhs, lamb):
+    '''Solves (I + lamb * L) X = rhs, where L = Dx^T Dx + Dy^T Dy is the image Laplacian
+       built from forward differences that stop at the image border.
+
+    The DCTs run through scipy.fft in O(nm log nm) when scipy is available, and as dense
+    matrix products otherwise.
+
+    Args:
+        rhs (np.ndarray): The right hand side image, or a (B, n, m) stack of them.
+        lamb (float): The weight of the Laplacian.
+
+    Returns:
+        X (np.ndarray): The solution of the system, in the floating point type of rhs.
+    '''
+    dtype = rhs.dtype if np.issubdtype(rhs.dtype, np.floating) else np.float64
+    if fft is None:
+        basis_rows, eig_rows = (a.astype(dtype, copy=False) for a in dct_basis(rhs.shape[-2]))
+        basis_cols, eig_cols = (a.astype(dtype, copy=False) for a in dct_basis(rhs.shape[-1]))
+        coeffs = basis_rows @ rhs @ basis_cols.T
+    else:
+        eig_rows = laplacian_eigenvalues(rhs.shape[-2]).astype(dtype, copy=False)
+        eig_cols = laplacian_eigenvalues(rhs.shape[-1]).astype(dtype, copy=False)
+        coeffs = fft.dctn(rhs.astype(dtype, copy=False), type=2, axes=(-2, -1), norm='ortho')
+
+    coeffs /= 1 + lamb * (eig_rows[:, None] + eig_cols[None, :])
+    if fft is None:
+        return basis_rows.T @ coeffs @ basis_cols
+    return fft.idctn(coeffs, type=2, axes=(-2, -1), norm='ortho', overwrite_x=True)
+
+
+@lru_cache(maxsize=16)
+def laplacian_eigenvalues(n):
+    '''Calculates the eigenvalues of the Laplacian of a path of n pixels with reflective
+       (Neumann) boundaries, in the order of the DCT-II basis.
+
+    Args:
+        n (int): The number of pixels along the axis.
+
+    Returns:
+        eigenvalues (np.ndarray): The eigenvalue of each basis vector. It is cached, so it is read-only.
+    '''
+    eigenvalues = 2 - 2 * np.cos(np.pi * np.arange(n) / n)
+    eigenvalues.flags.writeable = False
+    return eigenvalues
@@ -0,0 +1,97 @@
+'''Tiled, multi-process execution of the patch-based filters. '''
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from filters.instrumentation import Instrumentation, progress
+
+
+def get_tiles(padded_shape, pad, tile_size, halo):
+    '''Splits the patch centers of a padded image into tiles.
+
+    Args:
+        padded_shape (tuple): The shape of the padded image, or of a (..., n, m) stack of them.
+        pad (int): The padding added to the image (half the patch size).
+        tile_size (int): The number of patch centers along each side of a tile. If None,
+            a single tile covers the whole image.
+        halo (int): The extra rows/cols around a tile that its computation reads.
+
+    Returns:
+        tiles (list): The (region, window) of each tile, where region holds the (row, col)
+            slices of the patch centers and window holds the (row, col) slices of the
+            padded image needed to process them.
+    '''
+
+    n, m = padded_shape[-2:]
+    if tile_size is None:
+        tile_size = max(n, m)
+
+    tiles = []
+    for top in range(pad, n - pad, tile_size):
+        for left in range(pad, m - pad, tile_size):
+            bottom, right = min(top + tile_size, n - pad), min(left + tile_size, m - pad)
+            region = (slice(top, bottom), slice(left, right))
+            window = (slice(max(0, top - halo), min(n, bottom + halo)), slice(max(0, left - halo), min(m, right + halo)))
+            tiles.append((region, window))
+    return tiles
+
+
+def map_tiles(worker, padded_im, tiles, max_workers, *args, tile_args=None, instrument=None):
+    '''Runs worker(padded_window, local_region, *args, *tile_args[i], instrument=instrument) on
+       every tile, in a pool of processes when there is more than one tile and more than one worker.
+
+    Args:
+        worker (callable): A picklable, module-level function to run on each tile.
+        padded_im (np.ndarray): The padded image, or a (..., n, m) stack of them.
+        tiles (list): The (region, window) of each tile, as returned by get_tiles.
+        max_workers (int): The maximum number of processes. If None, uses every CPU.
+        *args: Extra arguments passed to every call of worker.
+        tile_args (list): If given, a tuple of extra arguments for each tile, passed after args.
+        instrument (Instrumentation): The instrumentation to report to, or None. Worker
+            processes collect their own counters and timers, which are merged into it.
+
+    Returns:
+        results (list): The result of worker for each tile, in the same order as tiles.
+    '''
+
+    windows, regions = [], []
+    for region, window in tiles:
+        windows.append(padded_im[(Ellipsis,) + window])
+        regions.append(tuple(slice(r.start - w.start, r.stop - w.start) for r, w in zip(region, window)))
+
+    if tile_args is None:
+        tile_args = [()] * len(tiles)
+    all_args = [args + tuple(extra_args) for extra_args in tile_args]
+
+    results = []
+    if len(tiles) == 1 or max_workers == 1:
+        for window, region, worker_args in zip(windows, regions, all_args):
+            results.append(worker(window, region, *worker_args, instrument=instrument))
+            progress(instrument, 'tiles', len(results), len(tiles))
+        return results
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for result, summary in executor.map(_run_tile, repeat(worker), windows, regions, all_args, repeat(instrument is not None)):
+            if summary is not None:
+                instrument.merge(summary['counters'], summary['timers'])
+            results.append(result)
+            progress(instrument, 'tiles', len(results), len(tiles))
+    return results
+
+
+def _run_tile(worker, window, region, args, instrumented):
+    '''Runs a tile in a worker process, with its own instrumentation if enabled.
+
+    Args:
+        worker (callable): The function to run on the tile.
+        window (np.ndarray): The padded window of the tile.
+        region (tuple): The (row, col) slices of the window holding the tile's patch centers.
+        args (tuple): Extra arguments passed to worker.
+        instrumented (bool): Whether to collect counters and timers.
+
+    Returns:
+        result: The result of worker.
+        summary (dict): The collected counters and timers, or None if not instrumented.
+    '''
+    instrument = Instrumentation() if instrumented else None
+    result = worker(window, region, *args, instrument=instrument)
+    return result, (instrument.summary() if instrumented else None)
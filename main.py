@@ -1,138 +1,186 @@
-'''Main file for running experiments.'''
+'''Main file for running experiments.
 
-import time
-import pickle
+Run it as a script to choose the algorithms, images, noise and noise levels, e.g.
+
+    python main.py --algos nlm TV --images boat --noise gaussian --params 0.01 0.05
+
+Only the filters that are run get imported, and matplotlib is only imported when
+figures are drawn, so short jobs are not dominated by interpreter startup.
+'''
+
+import os
+import argparse
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-from filters.quadratic_filter import quadratic_filter
-from filters.TV_filter import TV_filter
-from filters.TV_filter_pd import TV_filter_pd
-from filters.non_local_means_filter import non_local_means_filter
-from filters.non_local_wnnm_filter import non_local_wnnm_filter
-from utilities.utils import read_image, add_gaussian_noise, add_poisson_noise, PSNR, create_results_directory, normalize_image
+from utilities.figure_writer import WRITE_FORMATS, FigureWriter
+from utilities.results_table import group_by, load_results
+from utilities.runner import ALGORITHMS, make_noisy_image, run_experiment
+from utilities.metrics import batch_psnr
+from utilities.utils import read_image, create_results_directory
+
+
+ALGORITHM_FIGURES = {
+    'quad': ('quad', 'Quadratic Image'),
+    'TV': ('tv', 'TV Image'),
+    'nlm': ('nlm', 'Non-local means Image'),
+    'wnnm': ('wnnm', 'Weighted Nuclear Norm Minimization Image'),
+}
+IMAGES = ['clock', 'boat', 'aerial', 'bridge', 'couple']
+HYPERPARAMETERS = {
+    'gaussian': [0.01, 0.025, 0.05],
+    'poisson': [50, 20, 10],
+}
 
 
-def main(noise_type='gaussian', plot=False, savefigs=True):
+def main(noise_type='gaussian', plot=False, savefigs=True, max_workers=None, dtype=np.float64, write_format='figure',
+         algos=ALGORITHMS, images=IMAGES, hyperparameters=None):
     '''Runs the various filters on the provided images with varying noise levels
        and saves the results.
 
+    Every (image, noise level, algorithm) cell runs on a pool of processes and is cached
+    on disk, so rerunning the experiment only computes the missing cells. The PSNR, SSIM,
+    runtime, peak memory and iterations of every cell are appended to
+    ./results/<noise_type>/results.npz. Each result is saved on a background thread as
+    soon as its cell finishes, so that writing images never holds up the experiment.
+
     Args:
         noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
-        plot (bool): Whether to plot the noisy and cleaned images.
+        plot (bool): Whether to plot the noisy and cleaned images once every cell is done.
         savefigs (bool): Whether to save the generated images.
+        max_workers (int): The maximum number of processes. If None, uses every CPU.
+        dtype (np.dtype): The floating point type of the computation, e.g. np.float32.
+        write_format (str): How images are saved: 'figure' for titled matplotlib figures, or
+            'png' or 'npy' for the raw pixels without matplotlib.
+        algos (list): The algorithms to run, from ALGORITHMS.
+        images (list): The list of image names, e.g. 'clock'.
+        hyperparameters (list): The noise levels. Defaults to HYPERPARAMETERS[noise_type].
     '''
 
-    np.random.seed(0)
+    if hyperparameters is None:
+        hyperparameters = HYPERPARAMETERS[noise_type]
 
-    PSNR_results = {'quad': {}, 'TV': {}, 'nlm': {}, 'wnnm': {}}
-    time_results = {'quad': {}, 'TV': {}, 'nlm': {}, 'wnnm': {}}
+    create_results_directory(noise_type, images, hyperparameters)
 
-    images = ['clock', 'boat', 'aerial', 'bridge', 'couple']
+    with FigureWriter(write_format) as writer:
+        on_result = None
+        if savefigs is True:
+            for im_name in images:
+                im = read_image(im_name, dtype=dtype)
+                for param in hyperparameters:
+                    noisy_im, _ = make_noisy_image(im, im_name, noise_type, param, dtype)
+                    writer.submit(f'{_results_path(noise_type, im_name, param)}/noisy', noisy_im, 'Noisy Image', original_im=im)
+
+            def on_result(key, result):
+                im_name, param, algo = key
+                file_name, title = ALGORITHM_FIGURES[algo]
+                writer.submit(f'{_results_path(noise_type, im_name, param)}/{file_name}', result['clean_im'],
+                              f'{title}, PSNR={round(result["PSNR"], 2)}')
+
+        results = run_experiment(images, noise_type, hyperparameters, algos, max_workers=max_workers, dtype=dtype,
+                                 on_result=on_result)
+
+    if plot is True:
+        for im_name in images:
+            for param in hyperparameters:
+                _show_cell(results, algos, im_name, noise_type, param, dtype)
+
+    table = load_results(f'./results/{noise_type}/results.npz')
+    table = table[table['dtype'] == np.dtype(dtype).name]
+    groups, PSNR_mean, _ = group_by(table, ['param', 'algo'], 'PSNR')
+    _, SSIM_mean, _ = group_by(table, ['param', 'algo'], 'SSIM')
+    _, seconds_mean, _ = group_by(table, ['param', 'algo'], 'seconds')
+    for (param, algo), PSNR_value, SSIM_value, seconds in zip(groups.tolist(), PSNR_mean, SSIM_mean, seconds_mean):
+        print(f'{param:>8} {algo:>5}: PSNR={PSNR_value:.2f}, SSIM={SSIM_value:.3f}, seconds={seconds:.2f}')
+
+
+def _results_path(noise_type, im_name, param):
+    '''Builds the results directory of a cell.
 
-    if noise_type == 'gaussian':
-        hyperparameters = [0.01, 0.025, 0.05]
-    elif noise_type == 'poisson':
-        hyperparameters = [50, 20, 10]
+    Args:
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        im_name (str): The name of the image (e.g. clock).
+        param (float): The noise hyperparameter.
 
-    create_results_directory(noise_type, images, hyperparameters)
+    Returns:
+        path (str): The directory of the cell's images.
+    '''
+    str_var = str(param).replace('.', '_')
+    return f'./results/{noise_type}/{im_name}/var_{str_var}'
+
+
+def _show_cell(results, algos, im_name, noise_type, param, dtype):
+    '''Plots the original, noisy and cleaned images of a cell, then closes the figures.
+
+    Args:
+        results (dict): The results of the experiment.
+        algos (list): The algorithms that were run.
+        im_name (str): The name of the image (e.g. clock).
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        param (float): The noise hyperparameter.
+        dtype (np.dtype): The floating point type of the computation.
+    '''
+    import matplotlib.pyplot as plt
 
-    for im_name in images:
-        for key in PSNR_results.keys():
-            PSNR_results[key][im_name] = []
-            time_results[key][im_name] = []
-
-        for param in hyperparameters:
-            str_var = str(param).replace('.', '_')
-
-            im = read_image(im_name)
-            if noise_type == 'gaussian':
-                noisy_im = add_gaussian_noise(im, mean=0, var=param)
-                variance = param
-            elif noise_type == 'poisson':
-                noisy_im = add_poisson_noise(im, photons=param)
-                variance = 0.5/param
-
-            start_time = time.time()
-
-            quad_im = quadratic_filter(noisy_im, 5)
-            quad_time = time.time()
-            quad_im = normalize_image(quad_im)
-
-            # TV_im = TV_filter(noisy_im, 0.3)
-            TV_im = TV_filter_pd(noisy_im, 6)
-            TV_time = time.time()
-            TV_im = normalize_image(TV_im)
-
-            nlm_im = non_local_means_filter(noisy_im, 7, 10, 0.1)
-            nlm_time = time.time()
-            nlm_im = normalize_image(nlm_im)
-
-            x = noisy_im
-            y = noisy_im
-            delta = 0.3
-            for _ in range(1):
-                y = x + delta*(noisy_im - y)
-                x = non_local_wnnm_filter(y, 7, 10, variance)
-                x = normalize_image(x)
-
-            wnnm_im = x
-
-            wnnm_time = time.time()
-
-            PSNR_results['quad'][im_name].append(PSNR(original_im=im, cleaned_im=quad_im))
-            PSNR_results['TV'][im_name].append(PSNR(original_im=im, cleaned_im=TV_im))
-            PSNR_results['nlm'][im_name].append(PSNR(original_im=im, cleaned_im=nlm_im))
-            PSNR_results['wnnm'][im_name].append(PSNR(original_im=im, cleaned_im=wnnm_im))
-
-            time_results['quad'][im_name].append(quad_time - start_time)
-            time_results['TV'][im_name].append(TV_time - quad_time)
-            time_results['nlm'][im_name].append(nlm_time - TV_time)
-            time_results['wnnm'][im_name].append(wnnm_time - nlm_time)
-
-            if plot is True or savefigs is True:
-                _, ax_original = plt.subplots()
-                ax_original.imshow(im, cmap='gray')
-                ax_original.set_title('Original Image')
-
-                fig_noisy, ax_noisy = plt.subplots()
-                ax_noisy.imshow(noisy_im, cmap='gray')
-                ax_noisy.set_title(f'Noisy Image, PSNR={round(PSNR(original_im=im, cleaned_im=noisy_im), 2)}')
-
-                fig_quad, ax_quad = plt.subplots()
-                ax_quad.imshow(quad_im, cmap='gray')
-                ax_quad.set_title(f'Quadratic Image, PSNR={round(PSNR(original_im=im, cleaned_im=quad_im), 2)}')
-
-                fig_tv, ax_tv = plt.subplots()
-                ax_tv.imshow(TV_im, cmap='gray')
-                ax_tv.set_title(f'TV Image, PSNR={round(PSNR(original_im=im, cleaned_im=TV_im), 2)}')
-
-                fig_nlm, ax_nlm = plt.subplots()
-                ax_nlm.imshow(nlm_im, cmap='gray')
-                ax_nlm.set_title(f'Non-local means Image, PSNR={round(PSNR(original_im=im, cleaned_im=nlm_im), 2)}')
-
-                fig_wnnm, ax_wnnm = plt.subplots()
-                ax_wnnm.imshow(wnnm_im, cmap='gray')
-                ax_wnnm.set_title(f'Weighted Nuclear Norm Minimization Image, PSNR={round(PSNR(original_im=im, cleaned_im=wnnm_im), 2)}')
-
-                if savefigs is True:
-                    fig_noisy.savefig(f'./results/{noise_type}/{im_name}/var_{str_var}/noisy.png')
-                    fig_quad.savefig(f'./results/{noise_type}/{im_name}/var_{str_var}/quad.png')
-                    fig_tv.savefig(f'./results/{noise_type}/{im_name}/var_{str_var}/tv.png')
-                    fig_nlm.savefig(f'./results/{noise_type}/{im_name}/var_{str_var}/nlm.png')
-                    fig_wnnm.savefig(f'./results/{noise_type}/{im_name}/var_{str_var}/wnnm.png')
-
-                if plot is True:
-                    plt.show()
-
-    print(PSNR_results)
-    print(time_results)
-    with open(f'./results/{noise_type}/PSNR_results.pkl', 'wb') as f:
-        pickle.dump(PSNR_results, f)
-    with open(f'./results/{noise_type}/time_results.pkl', 'wb') as f:
-        pickle.dump(time_results, f)
+    im = read_image(im_name, dtype=dtype)
+    noisy_im, _ = make_noisy_image(im, im_name, noise_type, param, dtype)
+
+    _, ax_original = plt.subplots()
+    ax_original.imshow(im, cmap='gray')
+    ax_original.set_title('Original Image')
+
+    _, ax_noisy = plt.subplots()
+    ax_noisy.imshow(noisy_im, cmap='gray')
+    ax_noisy.set_title(f'Noisy Image, PSNR={round(float(batch_psnr(im, noisy_im)), 2)}')
+
+    for algo in algos:
+        result = results[(im_name, param, algo)]
+        _, ax = plt.subplots()
+        ax.imshow(result['clean_im'], cmap='gray')
+        ax.set_title(f'{ALGORITHM_FIGURES[algo][1]}, PSNR={round(result["PSNR"], 2)}')
+
+    plt.show()
+    plt.close('all')
+
+
+def _number(text):
+    '''Parses a noise level, keeping whole numbers (e.g. photon counts) as ints so that they
+       name the same cache entries and result directories as the defaults.
+
+    Args:
+        text (str): The noise level.
+
+    Returns:
+        param (int or float): The noise level.
+    '''
+    return int(text) if text.lstrip('-').isdigit() else float(text)
+
+
+def parse_args(argv=None):
+    '''Parses the command line arguments.
+
+    Args:
+        argv (list): The arguments, defaulting to sys.argv.
+
+    Returns:
+        args (argparse.Namespace): The parsed arguments.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--algos', nargs='+', default=ALGORITHMS, choices=ALGORITHMS)
+    parser.add_argument('--images', nargs='+', default=IMAGES)
+    parser.add_argument('--noise', default='gaussian', choices=list(HYPERPARAMETERS))
+    parser.add_argument('--params', nargs='+', type=_number, help='The noise levels. Defaults to the ones of the report.')
+    parser.add_argument('--workers', type=int, help='The maximum number of processes. Defaults to every CPU.')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--format', default='figure', choices=WRITE_FORMATS, help='How result images are saved.')
+    parser.add_argument('--no-savefigs', action='store_true', help='Do not save any result images.')
+    parser.add_argument('--plot', action='store_true', help='Show the images of every cell once they are done.')
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    if not args.plot:
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+    main(args.noise, plot=args.plot, savefigs=not args.no_savefigs, max_workers=args.workers, dtype=np.dtype(args.dtype),
+         write_format=args.format, algos=args.algos, images=args.images, hyperparameters=args.params)
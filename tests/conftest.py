@@ -0,0 +1,15 @@
+'''Shared fixtures of the tests. '''
+import numpy as np
+import pytest
+
+
+VAR = 0.01
+
+
+@pytest.fixture
+def noisy_im():
+    '''A small smooth image with Gaussian noise, so that the patch groups are not empty. '''
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:40, 0:32]
+    clean_im = 0.5 + 0.25 * np.sin(rows / 5) * np.cos(cols / 7)
+    return clean_im + rng.normal(0, np.sqrt(VAR), clean_im.shape)
@@ -0,0 +1,81 @@
+'''Checks the split Bregman TV filter against an independent solve of its dual. '''
+import numpy as np
+import pytest
+
+from filters import TV_filter as TV_filter_module
+from filters import quadratic_filter as quadratic_filter_module
+from filters.TV_filter import TV_filter
+
+
+LAMB = 0.3
+
+
+@pytest.fixture
+def noisy_im():
+    rng = np.random.default_rng(0)
+    return np.clip(np.kron(rng.random((2, 3)), np.ones((5, 3))) + rng.normal(0, 0.1, (10, 9)), 0, 1)
+
+
+def _objective(clean_im, im, lamb):
+    '''The anisotropic TV objective, ||X - Y||^2 + lamb * (||Dx X||_1 + ||Dy X||_1). '''
+    return np.sum(np.square(clean_im - im)) + lamb * (np.abs(np.diff(clean_im, axis=-2)).sum() + np.abs(np.diff(clean_im, axis=-1)).sum())
+
+
+def _dual_solve(im, lamb, niter=3000):
+    '''Solves the problem through its dual, max over |p| <= 1 of lamb * <D^T p, Y> - lamb^2 / 4 * ||D^T p||^2,
+       with accelerated projected gradient steps, and returns the primal solution Y - lamb / 2 * D^T p.
+    '''
+    def adjoint(px, py):
+        return -np.diff(np.pad(px, [(1, 1), (0, 0)]), axis=0) - np.diff(np.pad(py, [(0, 0), (1, 1)]), axis=1)
+
+    px, py = np.zeros((im.shape[0] - 1, im.shape[1])), np.zeros((im.shape[0], im.shape[1] - 1))
+    qx, qy, t = px, py, 1
+    step = 1 / (4 * lamb**2)
+    for _ in range(niter):
+        clean_im = im - lamb / 2 * adjoint(qx, qy)
+        next_px = np.clip(qx + step * lamb * np.diff(clean_im, axis=0), -1, 1)
+        next_py = np.clip(qy + step * lamb * np.diff(clean_im, axis=1), -1, 1)
+        next_t = (1 + np.sqrt(1 + 4 * t**2)) / 2
+        qx = next_px + (t - 1) / next_t * (next_px - px)
+        qy = next_py + (t - 1) / next_t * (next_py - py)
+        px, py, t = next_px, next_py, next_t
+    return im - lamb / 2 * adjoint(px, py)
+
+
+def test_bregman_reaches_the_optimum(noisy_im):
+    optimum = _objective(_dual_solve(noisy_im, LAMB), noisy_im, LAMB)
+    objective = _objective(TV_filter(noisy_im, LAMB), noisy_im, LAMB)
+    # The default gap_tol certifies that the objective exceeds the optimum by less than 1e-4 of itself
+    assert optimum - 1e-12 <= objective and objective - optimum < 1e-4 * objective
+
+
+def test_stack_matches_single_images(noisy_im):
+    stack = np.stack([noisy_im, noisy_im[::-1]])
+    clean_ims = TV_filter(stack, LAMB, gap_tol=1e-9)
+    for clean_im, im in zip(clean_ims, stack):
+        np.testing.assert_allclose(clean_im, TV_filter(im, LAMB, gap_tol=1e-9), rtol=0, atol=1e-6)
+
+
+def test_zero_lambda_keeps_the_image(noisy_im):
+    clean_im = TV_filter(noisy_im, 0)
+    np.testing.assert_array_equal(clean_im, noisy_im)
+    assert clean_im is not noisy_im
+
+
+def test_cvxpy_backend_reaches_the_optimum(noisy_im):
+    pytest.importorskip('cvxpy')
+    optimum = _objective(_dual_solve(noisy_im, LAMB), noisy_im, LAMB)
+    assert _objective(TV_filter(noisy_im, LAMB, backend='cvxpy'), noisy_im, LAMB) == pytest.approx(optimum, rel=1e-4)
+
+
+def test_cvxpy_problems_are_reused(noisy_im):
+    pytest.importorskip('cvxpy')
+    problem = TV_filter_module._problem(noisy_im.shape)
+    quadratic_problem = quadratic_filter_module._cvxpy_problem(noisy_im.shape)
+    # A new lambda and image only change the parameters of the problem built for their shape
+    for lamb in (LAMB, 2 * LAMB):
+        optimum = _objective(_dual_solve(noisy_im[::-1], lamb), noisy_im[::-1], lamb)
+        assert _objective(TV_filter(noisy_im[::-1], lamb, backend='cvxpy'), noisy_im[::-1], lamb) == pytest.approx(optimum, rel=1e-4)
+        assert TV_filter_module._problem(noisy_im.shape) is problem
+    quadratic_filter_module.quadratic_filter(noisy_im, LAMB, backend='cvxpy')
+    assert quadratic_filter_module._cvxpy_problem(noisy_im.shape) is quadratic_problem
@@ -0,0 +1,56 @@
+'''Checks the primal-dual TV filter: its stopping criteria, stacks and float32. '''
+import numpy as np
+import pytest
+
+from filters.TV_filter_pd import TV_filter_pd
+
+
+LAMB = 2
+
+
+@pytest.fixture
+def noisy_ims():
+    '''A stack of small, non-square noisy images. '''
+    rng = np.random.default_rng(0)
+    return np.clip(0.5 + 0.3 * np.sign(rng.random((3, 1, 17)) - 0.5) + rng.normal(0, 0.1, (3, 12, 17)), 0, 1)
+
+
+def _objective(clean_im, im):
+    '''The isotropic TV objective the filter minimizes, with differences that stop at the border. '''
+    dx = np.diff(clean_im, axis=-1, append=clean_im[..., -1:])
+    dy = np.diff(clean_im, axis=-2, append=clean_im[..., -1:, :])
+    return np.sum(np.sqrt(dx**2 + dy**2)) + 0.5 * np.sum(np.square(clean_im - LAMB * im))
+
+
+def test_gap_bounds_the_objective(noisy_ims):
+    im = noisy_ims[0]
+    clean_im, stats = TV_filter_pd(im, LAMB, niter=2000, accelerate=True, gap_tol=1e-3, return_stats=True)
+    assert stats['converged'] and stats['iterations'] < 2000 and 0 <= stats['gap'] < 1e-3
+
+    optimum = _objective(TV_filter_pd(im, LAMB, niter=5000, accelerate=True), im)
+    objective = _objective(clean_im, im)
+    assert optimum <= objective <= optimum + stats['gap'] * objective
+
+
+def test_accelerated_and_plain_agree(noisy_ims):
+    im = noisy_ims[0]
+    np.testing.assert_allclose(TV_filter_pd(im, LAMB, niter=3000, accelerate=True),
+                               TV_filter_pd(im, LAMB, niter=3000, tau=0.25), rtol=0, atol=1e-3)
+
+
+def test_tol_stops_early(noisy_ims):
+    _, stats = TV_filter_pd(noisy_ims[0], LAMB, niter=1000, tol=1e-4, return_stats=True)
+    assert stats['converged'] and stats['rel_change'] < 1e-4 and stats['iterations'] < 1000
+
+
+def test_stack_matches_single_images(noisy_ims):
+    stacked = TV_filter_pd(noisy_ims, LAMB, niter=50, accelerate=True)
+    assert stacked.shape == noisy_ims.shape
+    for clean_im, im in zip(stacked, noisy_ims):
+        np.testing.assert_allclose(clean_im, TV_filter_pd(im, LAMB, niter=50, accelerate=True), rtol=0, atol=1e-12)
+
+
+def test_float32(noisy_ims):
+    clean_im = TV_filter_pd(noisy_ims[0], LAMB, niter=50, accelerate=True, dtype=np.float32)
+    assert clean_im.dtype == np.float32
+    np.testing.assert_allclose(clean_im, TV_filter_pd(noisy_ims[0], LAMB, niter=50, accelerate=True), rtol=0, atol=1e-4)
@@ -0,0 +1,47 @@
+'''Checks the approximate patch index against the exact block matching. '''
+import numpy as np
+import pytest
+
+from filters.block_matching import PatchIndex, matching_recall, similar_patches
+from filters.patch_utils import pad_images
+
+
+PATCH_SIZE = 5
+SEARCH_DIST = 8
+GROUP_SIZE = 10
+MAX_DISTANCE = 1.75
+
+
+@pytest.fixture
+def padded_im():
+    '''A small padded image with enough structure that the exact groups are full. '''
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:48, 0:40]
+    clean_im = 0.5 + 0.25 * np.sin(rows / 5) * np.cos(cols / 7)
+    return pad_images((clean_im + rng.normal(0, 0.1, clean_im.shape))[None], PATCH_SIZE // 2)
+
+
+def test_matching_recall():
+    exact = (np.array([[1, 2, 3]]), np.array([[1, 1, 1]]), np.array([3]))
+    assert matching_recall(exact, exact) == 1
+    assert matching_recall(exact, (np.array([[3, 1, 9]]), np.array([[1, 1, 1]]), np.array([3]))) == pytest.approx(2 / 3)
+    # Matches past the size of a group do not count
+    assert matching_recall(exact, (np.array([[3, 1, 2]]), np.array([[1, 1, 1]]), np.array([1]))) == pytest.approx(1 / 3)
+
+
+def test_windowed_index_recall(padded_im):
+    pad = PATCH_SIZE // 2
+    centers = (np.arange(pad, padded_im.shape[-2] - pad), np.arange(pad, padded_im.shape[-1] - pad))
+    exact = similar_patches(padded_im, PATCH_SIZE, SEARCH_DIST, centers, GROUP_SIZE, MAX_DISTANCE)
+
+    index = PatchIndex(search_dist=SEARCH_DIST)
+    patches = np.lib.stride_tricks.sliding_window_view(padded_im, (PATCH_SIZE, PATCH_SIZE), axis=(-2, -1))
+    approx = index.similar_patches(index.build(patches), patches, centers, GROUP_SIZE, MAX_DISTANCE)
+
+    _, ref_rows, ref_cols, match_rows, match_cols, _, group_sizes = approx
+    valid = np.arange(GROUP_SIZE) < group_sizes[:, None]
+    assert np.all(np.abs(match_rows - ref_rows[:, None])[valid] <= SEARCH_DIST)
+    assert np.all(np.abs(match_cols - ref_cols[:, None])[valid] <= SEARCH_DIST)
+    # The window holds plenty of close patches, so the groups are as full as the exact ones
+    np.testing.assert_array_equal(group_sizes, exact[6])
+    assert matching_recall(exact[3:5] + exact[6:], approx[3:5] + approx[6:]) >= 0.5
@@ -0,0 +1,48 @@
+'''Checks that the background figure writer saves every image and reports its errors. '''
+import os
+
+import numpy as np
+import pytest
+
+from utilities.figure_writer import FigureWriter
+
+
+def test_saves_every_image(tmp_path):
+    ims = np.random.default_rng(0).random((5, 8, 6))
+    with FigureWriter('npy', max_pending=2) as writer:
+        for idx, im in enumerate(ims):
+            writer.submit(str(tmp_path / f'im{idx}'), im)
+    for idx, im in enumerate(ims):
+        np.testing.assert_array_equal(np.load(tmp_path / f'im{idx}.npy'), im)
+
+
+def test_png(tmp_path):
+    with FigureWriter('png') as writer:
+        writer.submit(str(tmp_path / 'im'), np.linspace(0, 1, 12).reshape(3, 4))
+    assert os.path.exists(tmp_path / 'im.png')
+
+
+def test_writer_error_is_raised(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        with FigureWriter('npy') as writer:
+            writer.submit(str(tmp_path / 'missing' / 'im'), np.zeros((2, 2)))
+
+
+def test_writer_error_does_not_hide_the_body_error(tmp_path):
+    with pytest.raises(KeyError):
+        with FigureWriter('npy') as writer:
+            writer.submit(str(tmp_path / 'missing' / 'im'), np.zeros((2, 2)))
+            raise KeyError('the cell failed')
+
+
+def test_submit_after_an_error(tmp_path):
+    writer = FigureWriter('npy')
+    writer.submit(str(tmp_path / 'missing' / 'im'), np.zeros((2, 2)))
+    writer.close(raise_error=False)
+    with pytest.raises(FileNotFoundError):
+        writer.submit(str(tmp_path / 'im'), np.zeros((2, 2)))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        FigureWriter('jpeg')
@@ -0,0 +1,24 @@
+'''Checks that the image store gives back exactly the images it was given. '''
+import os
+
+import numpy as np
+
+from utilities.image_store import load_from_store, stored_entries, write_store
+
+
+def test_store_is_lossless(tmp_path):
+    im = np.random.default_rng(0).random((12, 10))
+    write_store({'im@12x10': ([1, 2], im)}, store_dir=str(tmp_path))
+
+    stored_im = load_from_store('im@12x10', [1, 2], store_dir=str(tmp_path))
+    assert stored_im.dtype == np.float64 and not stored_im.flags.writeable
+    np.testing.assert_array_equal(stored_im, im)
+    assert load_from_store('im@12x10', [1, 3], store_dir=str(tmp_path)) is None
+
+
+def test_float32_store_is_rebuilt(tmp_path):
+    write_store({'im@12x10': ([1, 2], np.zeros((12, 10)))}, store_dir=str(tmp_path))
+    np.save(os.path.join(tmp_path, 'store.npy'), np.zeros(120, dtype=np.float32))
+
+    assert load_from_store('im@12x10', [1, 2], store_dir=str(tmp_path)) is None
+    assert stored_entries(store_dir=str(tmp_path)) == {}
@@ -0,0 +1,62 @@
+'''Checks the batch quality metrics against straightforward implementations. '''
+import numpy as np
+import pytest
+
+from utilities.metrics import batch_psnr, batch_ssim, quality_metrics, tile_mse
+from utilities.utils import PSNR
+
+
+@pytest.fixture
+def images():
+    '''A stack of two small images and noisy copies of them. '''
+    rng = np.random.default_rng(0)
+    original_im = rng.random((2, 20, 18))
+    return original_im, np.clip(original_im + rng.normal(0, 0.1, original_im.shape), 0, 1)
+
+
+def _loop_ssim(original_im, cleaned_im, window, sigma):
+    '''The mean SSIM of an image, one window at a time. '''
+    kernel = np.exp(-0.5 * np.square((np.arange(window) - (window - 1) / 2) / sigma)) if sigma else np.ones(window)
+    weights = np.outer(kernel, kernel) / np.sum(kernel)**2
+    c1, c2 = 0.01**2, 0.03**2
+    scores = []
+    for row in range(original_im.shape[0] - window + 1):
+        for col in range(original_im.shape[1] - window + 1):
+            x = original_im[row:row + window, col:col + window]
+            y = cleaned_im[row:row + window, col:col + window]
+            mu_x, mu_y = np.sum(weights * x), np.sum(weights * y)
+            var_x, var_y = np.sum(weights * (x - mu_x)**2), np.sum(weights * (y - mu_y)**2)
+            cov = np.sum(weights * (x - mu_x) * (y - mu_y))
+            scores.append((2 * mu_x * mu_y + c1) * (2 * cov + c2) / ((mu_x**2 + mu_y**2 + c1) * (var_x + var_y + c2)))
+    return np.mean(scores)
+
+
+def test_psnr_matches_single_image(images):
+    original_im, cleaned_im = images
+    np.testing.assert_allclose(batch_psnr(original_im, cleaned_im), [PSNR(o, c) for o, c in zip(original_im, cleaned_im)])
+    assert batch_psnr(original_im[0], original_im[0]) == 100
+
+
+@pytest.mark.parametrize('sigma', [1.5, None])
+def test_ssim_matches_loop(images, sigma):
+    original_im, cleaned_im = images
+    np.testing.assert_allclose(batch_ssim(original_im, cleaned_im, window=7, sigma=sigma),
+                               [_loop_ssim(o, c, 7, sigma) for o, c in zip(original_im, cleaned_im)])
+    assert batch_ssim(original_im[0], original_im[0]) == pytest.approx(1)
+
+
+def test_tile_mse(images):
+    original_im, cleaned_im = images
+    mse = tile_mse(original_im, cleaned_im, tile_size=8)
+    assert mse.shape == (2, 3, 3)
+    np.testing.assert_allclose(mse[1, 2, 2], np.mean(np.square(original_im[1, 16:, 16:] - cleaned_im[1, 16:, 16:])))
+
+
+def test_cached_metrics_are_read_only(images):
+    original_im, cleaned_im = images
+    psnr = batch_psnr(original_im, cleaned_im).copy()
+    metrics = quality_metrics(original_im, cleaned_im)
+    with pytest.raises(ValueError):
+        metrics['PSNR'][0] = 0
+    metrics['PSNR'] = None
+    np.testing.assert_array_equal(batch_psnr(original_im, cleaned_im), psnr)
@@ -0,0 +1,31 @@
+'''Checks the vectorized NLM filter against the original pixel by pixel loop. '''
+import numpy as np
+
+from filters.non_local_means_filter import non_local_means_filter
+
+
+def _loop_non_local_means(im, patch_size, search_dist, h):
+    '''The original, pixel by pixel NLM filter. '''
+    pad = patch_size // 2
+    padded_im = np.pad(im, (pad, pad), mode='reflect')
+    n, m = padded_im.shape
+    clean_im = np.zeros(im.shape)
+    for row in range(pad, n - pad):
+        for col in range(pad, m - pad):
+            curr_patch = padded_im[row - pad:row + pad + 1, col - pad:col + pad + 1]
+            total_sum = 0
+            for s_row in range(max(pad, row - search_dist), min(n - pad, row + search_dist + 1)):
+                for s_col in range(max(pad, col - search_dist), min(m - pad, col + search_dist + 1)):
+                    if s_row == row and s_col == col:
+                        continue
+                    search_patch = padded_im[s_row - pad:s_row + pad + 1, s_col - pad:s_col + pad + 1]
+                    weight = np.exp(-np.sqrt(np.sum(np.square(curr_patch - search_patch))) / h)
+                    total_sum += weight
+                    clean_im[row - pad, col - pad] += weight * padded_im[s_row, s_col]
+            clean_im[row - pad, col - pad] /= total_sum
+    return clean_im
+
+
+def test_nlm_matches_loop(noisy_im):
+    im = noisy_im[:16, :12]
+    np.testing.assert_allclose(non_local_means_filter(im, 3, 2, 0.5), _loop_non_local_means(im, 3, 2, 0.5), rtol=0, atol=1e-12)
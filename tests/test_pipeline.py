@@ -0,0 +1,33 @@
+'''Checks that the streaming pipeline filters large images in strips exactly. '''
+import numpy as np
+import pytest
+
+from filters.non_local_means_filter import non_local_means_filter
+from filters.non_local_wnnm_filter import non_local_wnnm_filter
+from utilities.pipeline import filter_in_strips, get_strips, non_local_halo
+from utilities.runner import ALGORITHM_SETTINGS
+
+
+VAR = 0.01
+
+
+def test_strips_cover_every_row_once():
+    strips = get_strips(23, 10, 4)
+    assert [(rows.start, rows.stop) for rows, _ in strips] == [(0, 10), (10, 20), (20, 23)]
+    assert [(read_rows.start, read_rows.stop) for _, read_rows in strips] == [(0, 14), (6, 23), (16, 23)]
+
+
+@pytest.mark.parametrize('filter_name, filter_fn', [
+    ('nlm', lambda im: non_local_means_filter(im, 5, 4, 0.1)),
+    ('wnnm', lambda im: non_local_wnnm_filter(im, 5, 4, VAR)),
+])
+def test_strips_match_whole_image(noisy_im, filter_name, filter_fn):
+    out = np.empty_like(noisy_im)
+    filter_in_strips(filter_fn, noisy_im, out, strip_rows=10, halo=non_local_halo(5, 4, filter_name))
+    np.testing.assert_allclose(out, filter_fn(noisy_im), rtol=0, atol=1e-12)
+
+
+def test_default_halo_covers_runner_settings():
+    for filter_name in ('nlm', 'wnnm'):
+        settings = ALGORITHM_SETTINGS[filter_name]
+        assert non_local_halo(settings['patch_size'], settings['search_dist'], filter_name) <= 32
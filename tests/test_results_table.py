@@ -0,0 +1,58 @@
+'''Checks the results table: appending, loading the latest rows and aggregating them. '''
+import os
+
+import numpy as np
+import pytest
+
+from utilities.results_table import append_results, consolidate_results, group_by, load_results, make_rows, rows_from_pickles
+
+
+def _row(image, param, algo, psnr, dtype='float64'):
+    return (image, 'gaussian', param, algo, dtype, psnr, 0.5, 1.0, 1024, 1)
+
+
+def test_append_and_load(tmp_path):
+    path = str(tmp_path / 'results.npz')
+    assert len(load_results(path)) == 0
+
+    append_results(path, make_rows([_row('boat', 0.01, 'nlm', 20), _row('boat', 0.01, 'TV', 21)]))
+    append_results(path, make_rows([_row('boat', 0.01, 'nlm', 22), _row('boat', 0.01, 'nlm', 23, dtype='float32')]))
+    assert len(load_results(path, latest=False)) == 4
+
+    # The rerun of a cell replaces its earlier row, and the dtype is part of the cell
+    table = load_results(path)
+    assert table['PSNR'].tolist() == [21, 22, 23]
+    assert table['dtype'].tolist() == ['float64', 'float64', 'float32']
+
+
+def test_consolidate(tmp_path):
+    path = str(tmp_path / 'results.npz')
+    append_results(path, make_rows([_row('boat', 0.01, 'nlm', 20)]))
+    consolidate_results(path)
+    append_results(path, make_rows([_row('clock', 0.01, 'nlm', 21)]))
+    # A row cut short by an interrupted append is dropped
+    with open(str(tmp_path / 'results.rows'), 'ab') as f:
+        f.write(b'\0' * 10)
+
+    assert load_results(path)['image'].tolist() == ['boat', 'clock']
+    consolidate_results(path)
+    assert os.listdir(tmp_path) == ['results.npz']
+    assert load_results(path)['image'].tolist() == ['boat', 'clock']
+
+
+def test_group_by():
+    table = make_rows([_row('boat', 0.01, 'nlm', 20), _row('clock', 0.01, 'nlm', 24),
+                       _row('boat', 0.05, 'nlm', 18), _row('boat', 0.01, 'TV', 21)])
+    groups, mean, std = group_by(table, ['param', 'algo'], 'PSNR')
+    assert [tuple(group) for group in groups.tolist()] == [(0.01, 'TV'), (0.01, 'nlm'), (0.05, 'nlm')]
+    np.testing.assert_allclose(mean, [21, 22, 18])
+    np.testing.assert_allclose(std, [0, 2, 0])
+
+
+def test_rows_from_pickles():
+    psnr_results = {'nlm': {'boat': [26.0, 24.3], 'clock': [27.9, 25.7]}}
+    time_results = {'nlm': {'boat': [264.1, 268.8], 'clock': [286.0, 254.1]}}
+    table = rows_from_pickles(psnr_results, time_results, 'gaussian', [0.01, 0.025])
+    assert len(table) == 4
+    assert tuple(table[1][['image', 'param', 'algo', 'PSNR', 'seconds']]) == ('boat', 0.025, 'nlm', 24.3, 268.8)
+    assert np.isnan(table['SSIM']).all()
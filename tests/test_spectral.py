@@ -0,0 +1,51 @@
+'''Checks the DCT solver of the quadratic filter against the system it solves. '''
+import numpy as np
+import pytest
+
+from filters import spectral
+from filters.quadratic_filter import quadratic_filter
+from filters.spectral import dct_basis, laplacian_eigenvalues, solve_screened_poisson
+
+
+@pytest.fixture
+def noisy_im():
+    return np.random.default_rng(0).random((3, 12, 9))
+
+
+def _laplacian(im):
+    '''Applies Dx^T Dx + Dy^T Dy, with forward differences that stop at the border. '''
+    dx, dy = np.diff(im, axis=-2), np.diff(im, axis=-1)
+    pad_rows = [(0, 0)] * (im.ndim - 2) + [(1, 1), (0, 0)]
+    pad_cols = [(0, 0)] * (im.ndim - 2) + [(0, 0), (1, 1)]
+    return -np.diff(np.pad(dx, pad_rows), axis=-2) - np.diff(np.pad(dy, pad_cols), axis=-1)
+
+
+@pytest.mark.parametrize('use_fft', [True, False])
+def test_solve_screened_poisson(noisy_im, monkeypatch, use_fft):
+    if not use_fft:
+        monkeypatch.setattr(spectral, 'fft', None)
+    clean_im = solve_screened_poisson(noisy_im, 5)
+    np.testing.assert_allclose(clean_im + 5 * _laplacian(clean_im), noisy_im, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(clean_im[1], solve_screened_poisson(noisy_im[1], 5), rtol=0, atol=1e-14)
+
+
+@pytest.mark.parametrize('use_fft', [True, False])
+def test_float32_solve(noisy_im, monkeypatch, use_fft):
+    if not use_fft:
+        monkeypatch.setattr(spectral, 'fft', None)
+    clean_im = quadratic_filter(noisy_im.astype(np.float32), 5, dtype=np.float32)
+    assert clean_im.dtype == np.float32
+    np.testing.assert_allclose(clean_im, solve_screened_poisson(noisy_im, 5), rtol=0, atol=1e-5)
+
+
+def test_cached_arrays_are_read_only():
+    basis, eigenvalues = dct_basis(6)
+    assert not basis.flags.writeable and not eigenvalues.flags.writeable
+    assert not laplacian_eigenvalues(6).flags.writeable
+    np.testing.assert_allclose(basis @ basis.T, np.eye(6), rtol=0, atol=1e-14)
+
+
+def test_cvxpy_backend_agrees(noisy_im):
+    pytest.importorskip('cvxpy')
+    np.testing.assert_allclose(quadratic_filter(noisy_im[0], 5, backend='cvxpy'), quadratic_filter(noisy_im[0], 5),
+                               rtol=0, atol=1e-4)
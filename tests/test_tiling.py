@@ -0,0 +1,37 @@
+'''Checks that tiled (and multi-process) filtering matches filtering the whole image. '''
+import numpy as np
+import pytest
+
+from filters.non_local_means_filter import non_local_means_filter
+from filters.non_local_wnnm_filter import non_local_wnnm_filter
+from filters.tiling import get_tiles
+
+
+VAR = 0.01
+
+
+def test_tiles_cover_every_center_once():
+    counts = np.zeros((30, 25), dtype=int)
+    for region, window in get_tiles(counts.shape, 2, 8, 5):
+        counts[region] += 1
+        for r, w, size in zip(region, window, counts.shape):
+            assert w.start == max(0, r.start - 5) and w.stop == min(size, r.stop + 5)
+    # Every patch center of the padded image is in exactly one tile, and the padding in none
+    assert np.all(counts[2:-2, 2:-2] == 1) and counts.sum() == 26 * 21
+
+
+def test_nlm_tiled_matches_untiled(noisy_im):
+    whole = non_local_means_filter(noisy_im, 5, 4, 0.1)
+    np.testing.assert_allclose(non_local_means_filter(noisy_im, 5, 4, 0.1, tile_size=12), whole, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('stride', [1, 3])
+def test_wnnm_tiled_matches_untiled(noisy_im, stride):
+    whole = non_local_wnnm_filter(noisy_im, 5, 4, VAR, stride=stride)
+    tiled = non_local_wnnm_filter(noisy_im, 5, 4, VAR, stride=stride, tile_size=12)
+    np.testing.assert_allclose(tiled, whole, rtol=0, atol=1e-12)
+
+
+def test_nlm_processes_match_serial(noisy_im):
+    serial = non_local_means_filter(noisy_im, 5, 4, 0.1, tile_size=16)
+    np.testing.assert_array_equal(non_local_means_filter(noisy_im, 5, 4, 0.1, tile_size=16, max_workers=2), serial)
@@ -0,0 +1,44 @@
+'''Checks the WNNM filter options against their plain counterparts. '''
+import numpy as np
+import pytest
+
+from filters.block_matching import PatchIndex
+from filters.non_local_wnnm_filter import non_local_wnnm_filter
+from filters.patch_utils import strided_indices
+
+
+VAR = 0.01
+
+
+def test_strided_indices():
+    np.testing.assert_array_equal(strided_indices(slice(2, 10), 3), [2, 5, 8, 9])
+    assert len(strided_indices(slice(4, 4), 3)) == 0
+
+
+def test_stride_up_to_patch_size_covers_every_pixel(noisy_im):
+    assert np.all(np.isfinite(non_local_wnnm_filter(noisy_im[:20, :20], 3, 4, VAR, stride=3)))
+
+
+@pytest.mark.parametrize('options', [{'stride': 4}, {'stride': 0}, {'group_size': 0}])
+def test_invalid_options(noisy_im, options):
+    with pytest.raises(ValueError):
+        non_local_wnnm_filter(noisy_im, 3, 4, VAR, **options)
+
+
+def test_reused_matches_match_fresh(noisy_im):
+    fresh, matches = non_local_wnnm_filter(noisy_im, 5, 4, VAR, return_matches=True)
+    np.testing.assert_array_equal(non_local_wnnm_filter(noisy_im, 5, 4, VAR, matches=matches), fresh)
+
+
+def test_reused_index_matches_under_tiling(noisy_im):
+    # A global index matches patches far beyond the halo the search distance alone would give a tile
+    fresh, matches = non_local_wnnm_filter(noisy_im, 5, 4, VAR, index=PatchIndex(search_dist=None), return_matches=True)
+    tiled = non_local_wnnm_filter(noisy_im, 5, 4, VAR, tile_size=12, matches=matches)
+    np.testing.assert_allclose(tiled, fresh, rtol=0, atol=1e-12)
+
+
+def test_reused_matches_need_a_dividing_stride(noisy_im):
+    _, matches = non_local_wnnm_filter(noisy_im, 5, 4, VAR, stride=2, return_matches=True)
+    non_local_wnnm_filter(noisy_im, 5, 4, VAR, stride=4, matches=matches)
+    with pytest.raises(ValueError):
+        non_local_wnnm_filter(noisy_im, 5, 4, VAR, stride=3, matches=matches)
@@ -0,0 +1,108 @@
+'''Background writer for result images.
+
+Images are handed to a queue and rendered and saved on a separate thread, so that
+encoding PNGs never stalls the computation producing them. Figures are built with the
+object-oriented matplotlib API rather than pyplot, so they are freed as soon as they are
+saved and memory stays flat over a long sweep.
+'''
+
+import queue
+import threading
+
+import numpy as np
+from PIL import Image
+
+from utilities.metrics import batch_psnr
+
+
+WRITE_FORMATS = ('figure', 'png', 'npy')
+_STOP = object()
+
+
+class FigureWriter:
+    '''Saves images on a background thread.
+
+    Args:
+        write_format (str): How images are saved: 'figure' renders a titled matplotlib figure,
+            'png' writes the raw pixels as an 8-bit PNG and 'npy' writes the raw array.
+        max_pending (int): The number of images that can wait in the queue before submit blocks.
+    '''
+
+    def __init__(self, write_format='figure', max_pending=64):
+        if write_format not in WRITE_FORMATS:
+            raise ValueError(f'Unknown write format: {write_format}')
+        self.write_format = write_format
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An exception from the body is the real failure, so a writer error must not replace it
+        self.close(raise_error=exc_type is None)
+
+    def submit(self, path, im, title=None, original_im=None):
+        '''Queues an image to be saved.
+
+        Args:
+            path (str): The path of the file, without its extension.
+            im (np.ndarray): The image.
+            title (str): The title of the figure.
+            original_im (np.ndarray): If given, the PSNR of the image against it is appended
+                to the title.
+        '''
+        if self._error is not None:
+            raise self._error
+        self._queue.put((path, im, title, original_im))
+
+    def close(self, raise_error=True):
+        '''Waits for every queued image to be saved and stops the thread.
+
+        Args:
+            raise_error (bool): Whether to raise the first error the writer ran into, if any.
+        '''
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+    def _run(self):
+        '''Saves the queued images until close is called.'''
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, path, im, title, original_im):
+        '''Saves a single image in the writer's format.
+
+        Args:
+            path (str): The path of the file, without its extension.
+            im (np.ndarray): The image.
+            title (str): The title of the figure.
+            original_im (np.ndarray): The image the PSNR in the title is measured against.
+        '''
+        if self.write_format == 'npy':
+            np.save(f'{path}.npy', im)
+        elif self.write_format == 'png':
+            Image.fromarray(np.round(np.clip(im, 0, 1) * 255).astype(np.uint8)).save(f'{path}.png')
+        else:
+            from matplotlib.figure import Figure
+
+            if original_im is not None:
+                title = f'{title}, PSNR={round(float(batch_psnr(original_im, im)), 2)}'
+            fig = Figure()
+            ax = fig.add_subplot()
+            ax.imshow(im, cmap='gray')
+            ax.set_title(title)
+            fig.savefig(f'{path}.png')
@@ -0,0 +1,143 @@
+'''Preprocessed, memory-mapped image store.
+
+All images are kept as normalized float64 pixels in a single .npy file, so that loading
+one is lossless, next to a JSON index of
+the name, shape and offset of each image and the signature of the file it was decoded
+from. Images are returned as zero-copy views of the memory map.
+'''
+
+import os
+import json
+
+import numpy as np
+
+
+STORE_DIR = './images/cache'
+_STORE_FILE = 'store.npy'
+_INDEX_FILE = 'index.json'
+
+_opened = {}
+
+
+def store_key(filename, size):
+    '''Builds the index key of an image.
+
+    Args:
+        filename (str): The name of the image (e.g. clock).
+        size (tuple): The (width, height) it was resized to, or None for the native resolution.
+
+    Returns:
+        key (str): The key of the image in the index.
+    '''
+    if size is None:
+        return f'{filename}@native'
+    return f'{filename}@{size[0]}x{size[1]}'
+
+
+def source_signature(path):
+    '''Summarizes a source file so that stale store entries can be detected.
+
+    Args:
+        path (str): The path of the source file.
+
+    Returns:
+        signature (list): The modification time (ns) and size of the file.
+    '''
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _open_store(store_dir):
+    '''Opens (or reuses) the index and memory map of a store.
+
+    Args:
+        store_dir (str): The directory of the store.
+
+    Returns:
+        index (dict): The index of the store, empty if there is no store.
+        pixels (np.ndarray): The memory-mapped pixels, or None if there is no store.
+    '''
+    index_path = os.path.join(store_dir, _INDEX_FILE)
+    store_path = os.path.join(store_dir, _STORE_FILE)
+    try:
+        signature = (source_signature(index_path), source_signature(store_path))
+    except FileNotFoundError:
+        return {}, None
+
+    if store_dir in _opened and _opened[store_dir][0] == signature:
+        return _opened[store_dir][1:]
+
+    with open(index_path) as f:
+        index = json.load(f)
+    pixels = np.load(store_path, mmap_mode='r')
+
+    # The store and index are replaced one after the other, so they can briefly disagree,
+    # and stores written before the pixels were kept in float64 are rebuilt
+    if pixels.shape[0] != index['size'] or pixels.dtype != np.float64:
+        return {}, None
+
+    _opened[store_dir] = (signature, index['images'], pixels)
+    return index['images'], pixels
+
+
+def load_from_store(key, signature, store_dir=STORE_DIR):
+    '''Loads an image from the store, if it is there and up to date.
+
+    Args:
+        key (str): The key of the image (see store_key).
+        signature (list): The current signature of its source file (see source_signature).
+        store_dir (str): The directory of the store.
+
+    Returns:
+        im (np.ndarray): A read-only float64 view of the image, or None if it is missing or stale.
+    '''
+    index, pixels = _open_store(store_dir)
+    entry = index.get(key)
+    if entry is None or entry['signature'] != signature:
+        return None
+    return pixels[entry['offset']:entry['offset'] + np.prod(entry['shape'])].reshape(entry['shape'])
+
+
+def stored_entries(store_dir=STORE_DIR):
+    '''Lists the entries of the store.
+
+    Args:
+        store_dir (str): The directory of the store.
+
+    Returns:
+        entries (dict): The signature and image of each key.
+    '''
+    index, pixels = _open_store(store_dir)
+    return {key: (entry['signature'], pixels[entry['offset']:entry['offset'] + np.prod(entry['shape'])].reshape(entry['shape']))
+            for key, entry in index.items()}
+
+
+def write_store(entries, store_dir=STORE_DIR):
+    '''Writes a new store holding the given images, replacing the previous one.
+
+    Args:
+        entries (dict): The (signature, image) of each key.
+        store_dir (str): The directory of the store.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+
+    index = {}
+    offset = 0
+    for key, (signature, im) in entries.items():
+        index[key] = {'offset': offset, 'shape': list(im.shape), 'signature': signature}
+        offset += im.size
+
+    store_path = os.path.join(store_dir, _STORE_FILE)
+    index_path = os.path.join(store_dir, _INDEX_FILE)
+    pixels = np.lib.format.open_memmap(f'{store_path}.tmp', mode='w+', dtype=np.float64, shape=(offset,))
+    for key, (_, im) in entries.items():
+        pixels[index[key]['offset']:index[key]['offset'] + im.size] = im.ravel()
+    pixels.flush()
+    del pixels
+
+    with open(f'{index_path}.tmp', 'w') as f:
+        json.dump({'size': offset, 'images': index}, f)
+
+    _opened.pop(store_dir, None)
+    os.replace(f'{store_path}.tmp', store_path)
+    os.replace(f'{index_path}.tmp', index_path)
@@ -0,0 +1,207 @@
+'''Image quality metrics over stacks of images.
+
+Every metric takes (..., H, W) arrays and scores all the images of a stack at once. The
+metrics of a pair of stacks are computed together, sharing the squared error, and the
+most recent pairs are cached by content, so asking again for the same pair (e.g. for a
+figure title) is free. The cached metrics are shared by every caller, so they are read-only.
+'''
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from filters.patch_utils import box_sum
+
+
+_CACHE_SIZE = 256
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def quality_metrics(original_im, cleaned_im, tile_size=32, window=11, sigma=1.5, max_pixel=1.0):
+    '''Calculates the PSNR, SSIM and per-tile MSE between two images or stacks of images.
+
+    Args:
+        original_im (np.ndarray): The (..., H, W) original images (without any noise).
+        cleaned_im (np.ndarray): The (..., H, W) filtered images.
+        tile_size (int): The side length of the tiles of the MSE map.
+        window (int): The side length of the SSIM window.
+        sigma (float): The standard deviation of the Gaussian SSIM window, or None for a
+            uniform window.
+        max_pixel (float): The largest possible pixel value.
+
+    Returns:
+        metrics (dict): The 'PSNR' and 'SSIM' of each image, of shape (...), and the 'tile_MSE'
+            map of each image, of shape (..., ceil(H / tile_size), ceil(W / tile_size)), all
+            read-only.
+    '''
+    original_im = np.asarray(original_im)
+    cleaned_im = np.asarray(cleaned_im)
+    key = (_digest(original_im), _digest(cleaned_im), tile_size, window, sigma, max_pixel)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return dict(_cache[key])
+
+    original_im = original_im.astype(np.float64, copy=False)
+    cleaned_im = cleaned_im.astype(np.float64, copy=False)
+    squared_error = np.square(original_im - cleaned_im)
+    tile_sums, tile_sizes = _tile_sums(squared_error, tile_size)
+    mse = tile_sums.sum(axis=(-2, -1)) / (original_im.shape[-2] * original_im.shape[-1])
+
+    metrics = {
+        'PSNR': _psnr_from_mse(mse, max_pixel),
+        'SSIM': _ssim(original_im, cleaned_im, window, sigma, max_pixel),
+        'tile_MSE': tile_sums / tile_sizes,
+    }
+    for values in metrics.values():
+        # The metrics of a single image are NumPy scalars, which are immutable anyway
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+    with _cache_lock:
+        _cache[key] = metrics
+        if len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return dict(metrics)
+
+
+def batch_psnr(original_im, cleaned_im, max_pixel=1.0):
+    '''Calculates the Peak Signal-to-Noise Ratio (PSNR) of every image of a stack.
+
+    Args:
+        original_im (np.ndarray): The (..., H, W) original images (without any noise).
+        cleaned_im (np.ndarray): The (..., H, W) filtered images.
+        max_pixel (float): The largest possible pixel value.
+
+    Returns:
+        psnr (np.ndarray): The PSNR of each image, of shape (...). Identical images score 100.
+    '''
+    return quality_metrics(original_im, cleaned_im, max_pixel=max_pixel)['PSNR']
+
+
+def batch_ssim(original_im, cleaned_im, window=11, sigma=1.5, max_pixel=1.0):
+    '''Calculates the mean Structural Similarity (SSIM) of every image of a stack.
+
+    Args:
+        original_im (np.ndarray): The (..., H, W) original images (without any noise).
+        cleaned_im (np.ndarray): The (..., H, W) filtered images.
+        window (int): The side length of the SSIM window.
+        sigma (float): The standard deviation of the Gaussian window, or None for a uniform window.
+        max_pixel (float): The largest possible pixel value.
+
+    Returns:
+        ssim (np.ndarray): The SSIM of each image, of shape (...).
+    '''
+    return quality_metrics(original_im, cleaned_im, window=window, sigma=sigma, max_pixel=max_pixel)['SSIM']
+
+
+def tile_mse(original_im, cleaned_im, tile_size=32):
+    '''Calculates the mean squared error over the tiles of every image of a stack.
+
+    Args:
+        original_im (np.ndarray): The (..., H, W) original images (without any noise).
+        cleaned_im (np.ndarray): The (..., H, W) filtered images.
+        tile_size (int): The side length of the tiles. The last row and column of tiles
+            are smaller if the image is not a multiple of it.
+
+    Returns:
+        mse (np.ndarray): The (..., ceil(H / tile_size), ceil(W / tile_size)) MSE of each tile.
+    '''
+    return quality_metrics(original_im, cleaned_im, tile_size=tile_size)['tile_MSE']
+
+
+def _digest(im):
+    '''Hashes the content of an array.
+
+    Args:
+        im (np.ndarray): The array.
+
+    Returns:
+        digest (tuple): The shape, type and content hash of the array.
+    '''
+    return im.shape, im.dtype.str, hashlib.blake2b(np.ascontiguousarray(im).data, digest_size=16).digest()
+
+
+def _tile_sums(arr, tile_size):
+    '''Sums an array over the tiles of its last two axes.
+
+    Args:
+        arr (np.ndarray): The (..., H, W) array.
+        tile_size (int): The side length of the tiles.
+
+    Returns:
+        tile_sums (np.ndarray): The sum of each tile.
+        tile_sizes (np.ndarray): The number of pixels of each tile.
+    '''
+    n, m = arr.shape[-2:]
+    row_starts = np.arange(0, n, tile_size)
+    col_starts = np.arange(0, m, tile_size)
+    tile_sums = np.add.reduceat(np.add.reduceat(arr, row_starts, axis=-2), col_starts, axis=-1)
+    tile_sizes = np.outer(np.diff(np.append(row_starts, n)), np.diff(np.append(col_starts, m)))
+    return tile_sums, tile_sizes
+
+
+def _psnr_from_mse(mse, max_pixel):
+    '''Converts mean squared errors to PSNRs, scoring a perfect match as 100.
+
+    Args:
+        mse (np.ndarray): The mean squared errors.
+        max_pixel (float): The largest possible pixel value.
+
+    Returns:
+        psnr (np.ndarray): The PSNRs.
+    '''
+    with np.errstate(divide='ignore'):
+        psnr = 20 * np.log10(max_pixel / np.sqrt(mse))
+    return np.where(mse == 0, 100.0, psnr)
+
+
+def _window_mean(arr, window, sigma):
+    '''Averages every window over the last two axes of an array with a separable filter.
+
+    Args:
+        arr (np.ndarray): The (..., H, W) array.
+        window (int): The side length of the window.
+        sigma (float): The standard deviation of the Gaussian window, or None for a uniform window.
+
+    Returns:
+        means (np.ndarray): The mean of every window that fits in the array, of shape
+            (..., H - window + 1, W - window + 1).
+    '''
+    if sigma is None:
+        return box_sum(arr, window) / window**2
+
+    kernel = np.exp(-0.5 * np.square((np.arange(window) - (window - 1) / 2) / sigma))
+    kernel /= kernel.sum()
+    rows = np.lib.stride_tricks.sliding_window_view(arr, window, axis=-2) @ kernel
+    return np.lib.stride_tricks.sliding_window_view(rows, window, axis=-1) @ kernel
+
+
+def _ssim(original_im, cleaned_im, window, sigma, max_pixel):
+    '''Calculates the mean SSIM of every image, over the windows that fit in the image.
+
+    Args:
+        original_im (np.ndarray): The (..., H, W) original images.
+        cleaned_im (np.ndarray): The (..., H, W) filtered images.
+        window (int): The side length of the window.
+        sigma (float): The standard deviation of the Gaussian window, or None for a uniform window.
+        max_pixel (float): The largest possible pixel value.
+
+    Returns:
+        ssim (np.ndarray): The SSIM of each image.
+    '''
+    c1 = (0.01 * max_pixel)**2
+    c2 = (0.03 * max_pixel)**2
+
+    # The five local moments are filtered together as one stack
+    moments = _window_mean(np.stack([original_im, cleaned_im, original_im * original_im,
+                                     cleaned_im * cleaned_im, original_im * cleaned_im]), window, sigma)
+    mu_x, mu_y, xx, yy, xy = moments
+    var_x = xx - mu_x * mu_x
+    var_y = yy - mu_y * mu_y
+    cov = xy - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return ssim_map.mean(axis=(-2, -1))
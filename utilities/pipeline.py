@@ -0,0 +1,261 @@
+'''Streaming denoising pipeline for directories of images and images too large for memory.
+
+Each image goes through read -> noise model (or real noisy input) -> filter -> normalize
+-> PSNR -> write. Images are read ahead on a thread pool, and every stage works on
+overlapping strips of rows, so memory stays bounded by the strip size and the prefetch
+depth rather than by the dataset or image size. Large inputs can be given as .npy files,
+which are memory-mapped instead of loaded.
+'''
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from utilities.utils import normalize_image
+
+
+IMAGE_EXTENSIONS = ('.png', '.npy')
+
+
+def list_images(directory, extensions=IMAGE_EXTENSIONS):
+    '''Lists the images of a directory, sorted by name.
+
+    Args:
+        directory (str): The directory to search.
+        extensions (tuple): The file extensions to include.
+
+    Returns:
+        paths (list): The paths of the images.
+    '''
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(extensions))
+
+
+def load_image(path, dtype=np.float64):
+    '''Loads an image. PNG files are decoded and normalized to have pixels between 0 and 1,
+       while .npy files are memory-mapped as they are.
+
+    Args:
+        path (str): The path of the image.
+        dtype (np.dtype): The floating point type of decoded PNG files.
+
+    Returns:
+        im (np.ndarray): The image, possibly a read-only memory map.
+    '''
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return normalize_image(np.array(Image.open(path).convert('L'), dtype=dtype))
+
+
+def prefetch_images(paths, prefetch=2, max_workers=2, dtype=np.float64):
+    '''Yields (path, image) pairs while the next images are read on a thread pool.
+
+    Args:
+        paths (list): The paths of the images.
+        prefetch (int): The number of images read ahead of the one being processed.
+        max_workers (int): The number of reading threads.
+        dtype (np.dtype): The floating point type of decoded PNG files.
+
+    Yields:
+        path (str): The path of the image.
+        im (np.ndarray): The loaded image.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(load_image, path, dtype)))
+            if len(pending) > prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def get_strips(n, strip_rows, halo):
+    '''Splits n rows into strips, each read with a halo of extra rows on both sides.
+
+    Args:
+        n (int): The number of rows.
+        strip_rows (int): The number of rows written by each strip.
+        halo (int): The number of extra rows read on each side of a strip.
+
+    Returns:
+        strips (list): The (rows, read_rows) slices of each strip.
+    '''
+    strips = []
+    for top in range(0, n, strip_rows):
+        bottom = min(top + strip_rows, n)
+        strips.append((slice(top, bottom), slice(max(0, top - halo), min(n, bottom + halo))))
+    return strips
+
+
+def non_local_halo(patch_size, search_dist, filter_name='nlm'):
+    '''Calculates the smallest halo for which filtering in strips matches filtering the
+       whole image with a non-local filter.
+
+    NLM only compares the patch of each pixel with the patches of its search window, so
+    its reach is patch_size // 2 + search_dist. WNNM also writes every cleaned patch back to
+    the pixels of the patches it matched, so a pixel depends on reference patches up to
+    that reach away, whose own matches lie another reach further out. Strided WNNM
+    (stride > 1) picks its reference grid per strip, so it only approximates the whole image.
+
+    Args:
+        patch_size (int): The size of patches to consider.
+        search_dist (int): The distance from the center pixel of a patch to look.
+        filter_name (str): The filter, either 'nlm' or 'wnnm'.
+
+    Returns:
+        halo (int): The number of extra rows each strip needs on both sides.
+    '''
+    if filter_name not in ('nlm', 'wnnm'):
+        raise ValueError(f'Unknown non-local filter: {filter_name}')
+    reach = patch_size // 2 + search_dist
+    return 2 * reach if filter_name == 'wnnm' else reach
+
+
+def filter_in_strips(filter_fn, im, out, strip_rows=256, halo=32):
+    '''Applies a filter to overlapping strips of an image and writes the inner rows of each.
+
+    The result matches filtering the whole image wherever the filter only looks at most
+    halo rows away (see non_local_halo for the non-local filters), and approximates it for
+    global filters such as TV.
+
+    Args:
+        filter_fn (callable): The filter, taking and returning a 2D image.
+        im (np.ndarray): The image to be filtered.
+        out (np.ndarray): The array the filtered image is written to.
+        strip_rows (int): The number of rows written by each strip.
+        halo (int): The number of extra rows read on each side of a strip.
+    '''
+    for rows, read_rows in get_strips(im.shape[0], strip_rows, halo):
+        clean_strip = filter_fn(np.asarray(im[read_rows]))
+        out[rows] = clean_strip[rows.start - read_rows.start:rows.stop - read_rows.start]
+
+
+def normalize_in_strips(im, strip_rows=256):
+    '''Normalizes an image in place, like normalize_image, reading it one strip at a time.
+
+    Args:
+        im (np.ndarray): The image (or writable memory map) to be normalized.
+        strip_rows (int): The number of rows per strip.
+    '''
+    strips = [rows for rows, _ in get_strips(im.shape[0], strip_rows, 0)]
+    max_pixel = max(np.max(im[rows]) for rows in strips)
+    min_pixel = min(np.min(im[rows]) for rows in strips)
+    for rows in strips:
+        im[rows] = (im[rows] - min_pixel) / max_pixel
+
+
+def add_noise_in_strips(im, out, noise_type, param, seed=0, strip_rows=256):
+    '''Adds noise to an image one strip at a time, then normalizes it like
+       add_gaussian_noise and add_poisson_noise do.
+
+    Args:
+        im (np.ndarray): The original image.
+        out (np.ndarray): The array the noisy image is written to.
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        param (float): The noise variance ('gaussian') or number of photons ('poisson').
+        seed (int): The seed of the noise generator.
+        strip_rows (int): The number of rows per strip.
+    '''
+    rng = np.random.default_rng(seed)
+    for rows, _ in get_strips(im.shape[0], strip_rows, 0):
+        strip = np.asarray(im[rows])
+        if noise_type == 'gaussian':
+            out[rows] = strip + rng.normal(0, param**0.5, strip.shape)
+        elif noise_type == 'poisson':
+            out[rows] = rng.poisson(strip * param) / param
+        else:
+            raise ValueError(f'Unknown noise type: {noise_type}')
+    normalize_in_strips(out, strip_rows)
+
+
+def psnr_in_strips(original_im, cleaned_im, strip_rows=256):
+    '''Calculates the PSNR between two images, like PSNR, one strip at a time.
+
+    Args:
+        original_im (np.ndarray): The original image (without any noise).
+        cleaned_im (np.ndarray): The filtered image.
+        strip_rows (int): The number of rows per strip.
+
+    Returns:
+        psnr (float): The peak signal-to-noise ratio.
+    '''
+    squared_error = 0.0
+    for rows, _ in get_strips(original_im.shape[0], strip_rows, 0):
+        squared_error += np.sum(np.square(np.asarray(original_im[rows]) - np.asarray(cleaned_im[rows])))
+    mse = squared_error / original_im.size
+    if mse == 0:
+        return 100
+    return float(20 * np.log10(1.0 / np.sqrt(mse)))
+
+
+def _allocate(shape, output_dir, name, dtype=np.float64):
+    '''Allocates an image, memory-mapped to a .npy file if an output directory is given.
+
+    Args:
+        shape (tuple): The shape of the image.
+        output_dir (str): The output directory, or None to allocate in memory.
+        name (str): The file name (without extension) of the memory map.
+        dtype (np.dtype): The floating point type of the image.
+
+    Returns:
+        im (np.ndarray): The allocated image.
+    '''
+    if output_dir is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(os.path.join(output_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def denoise_stream(paths, filter_fn, noise_type=None, param=None, output_dir=None, strip_rows=256, halo=32, prefetch=2, seed=0,
+                   dtype=np.float64):
+    '''Denoises a sequence of images, one result at a time.
+
+    Args:
+        paths (list): The paths of the images (see list_images).
+        filter_fn (callable): The filter, taking and returning a 2D image.
+        noise_type (str): The noise to add, 'gaussian' or 'poisson'. If None, the images are
+            treated as real noisy inputs and no PSNR is computed.
+        param (float): The noise variance ('gaussian') or number of photons ('poisson').
+        output_dir (str): If given, the noisy and cleaned images are written there as .npy
+            memory maps. Otherwise they are kept in memory and returned.
+        strip_rows (int): The number of rows per strip.
+        halo (int): The number of extra rows each filtered strip reads on both sides. The
+            default covers the non-local filters with the experiment settings of
+            utilities.runner (26 rows for WNNM); see non_local_halo for other settings.
+        prefetch (int): The number of images read ahead.
+        seed (int): The seed of the noise generator.
+        dtype (np.dtype): The floating point type of the decoded, noisy and cleaned images.
+
+    Yields:
+        result (dict): The name, PSNR (or None), filter runtime in seconds, and the cleaned
+            image (or its path, if output_dir is given) of each image.
+    '''
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    for path, im in prefetch_images(paths, prefetch, dtype=dtype):
+        name = os.path.splitext(os.path.basename(path))[0]
+
+        if noise_type is None:
+            noisy_im = im
+        else:
+            noisy_im = _allocate(im.shape, output_dir, f'{name}_noisy', dtype)
+            add_noise_in_strips(im, noisy_im, noise_type, param, seed, strip_rows)
+
+        clean_im = _allocate(im.shape, output_dir, f'{name}_clean', dtype)
+        start_time = time.time()
+        filter_in_strips(filter_fn, noisy_im, clean_im, strip_rows, halo)
+        seconds = time.time() - start_time
+        normalize_in_strips(clean_im, strip_rows)
+
+        psnr = None if noise_type is None else psnr_in_strips(im, clean_im, strip_rows)
+        if output_dir is not None:
+            clean_im.flush()
+            clean_im = clean_im.filename
+
+        yield {'name': name, 'PSNR': psnr, 'seconds': seconds, 'clean_im': clean_im}
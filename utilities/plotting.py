@@ -1,46 +1,51 @@
 '''Plotting functions. '''
 
-import pickle
-from collections import defaultdict
-
 import numpy as np
 import matplotlib.pyplot as plt
 
+from utilities.results_table import group_by, load_results
+
 
 ordered_algos = ['quad', 'TV', 'nlm', 'wnnm']
 algo_colors = {'quad':'cornflowerblue', 'TV':'goldenrod', 'nlm':'pink', 'wnnm':'tomato'}
 
 
-def plot_experiment(all_results, noise_type):
-    '''Plots the results for every hyperparameter variation.
+def plot_experiment(table, noise_type, column='PSNR', dtype='float64'):
+    '''Plots the mean (and standard deviation over images) of a result column for every
+       hyperparameter variation.
 
     Args:
-        all_results (dict): The dictionary containing the data.
+        table (np.ndarray): The results table (see utilities.results_table).
         noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        column (str): The column to plot, e.g. 'PSNR', 'seconds' or 'peak_memory'.
+        dtype (str): The floating point type of the runs to plot, e.g. 'float32'.
     '''
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
 
-    cert_data = defaultdict(list)
-    cert_data_std = defaultdict(list)
-    labels = []
+    table = table[(table['noise'] == noise_type) & (table['dtype'] == dtype) & np.isin(table['algo'], ordered_algos)]
+    groups, mean, std = group_by(table, ['param', 'algo'], column)
 
+    # Order the hyperparameters from the least to the most noise
+    hyperparameters, param_idx = np.unique(groups['param'], return_inverse=True)
+    param_idx = param_idx.ravel()
+    if noise_type == 'poisson':
+        hyperparameters = hyperparameters[::-1]
+        param_idx = len(hyperparameters) - 1 - param_idx
     if noise_type == 'gaussian':
-        hyperparameters = [0.01, 0.025, 0.05]
-    elif noise_type == 'poisson':
-        hyperparameters = [50, 20, 10]
-
-    for param_idx, param in enumerate(hyperparameters):
-        if noise_type == 'gaussian':
-            labels.append(r'$\sigma$' + f'={param}')
-        elif noise_type == 'poisson':
-            labels.append(f'Photons={param}')
+        labels = [r'$\sigma$' + f'={param:g}' for param in hyperparameters]
+    else:
+        labels = [f'Photons={param:g}' for param in hyperparameters]
 
-        for algo in ordered_algos:
-            raw_data = [all_results[algo][im][param_idx] for im in all_results[algo].keys() if im != 'noisy']
-            cert_data[algo].append(np.mean(raw_data))
-            cert_data_std[algo].append(np.std(raw_data))
+    cert_data = {}
+    cert_data_std = {}
+    for algo in ordered_algos:
+        members = groups['algo'] == algo
+        cert_data[algo] = np.full(len(hyperparameters), np.nan)
+        cert_data_std[algo] = np.full(len(hyperparameters), np.nan)
+        cert_data[algo][param_idx[members]] = mean[members]
+        cert_data_std[algo][param_idx[members]] = std[members]
 
     num_bars = len(ordered_algos)
     width = 1/(num_bars+1)
@@ -56,9 +61,9 @@ def plot_experiment(all_results, noise_type):
         position = ((num_bars-1)/2.0 - idx)*width
         bars[algo] = ax.bar(x - position, cert_data[algo], yerr=cert_data_std[algo], width=width, label=f'{algo_name}', color=algo_colors[algo], capsize=10)
 
-    plt.xticks(range(3), labels, fontsize=25)
+    plt.xticks(range(len(labels)), labels, fontsize=25)
     ax.legend(fontsize=25, loc='lower left')
-    ax.set_ylabel('PSNR', fontsize=25)
+    ax.set_ylabel(column, fontsize=25)
 
     for algo in ordered_algos:
         rounded_labels = []
@@ -80,9 +85,4 @@ def plot_experiment(all_results, noise_type):
 
 if __name__ == '__main__':
     noise_name = 'gaussian'
-    with open(f'./results/{noise_name}/PSNR_results.pkl', 'rb') as f:
-        PSNR_data = pickle.load(f)
-    with open(f'./results/{noise_name}/time_results.pkl', 'rb') as f:
-        time_data = pickle.load(f)
-
-    plot_experiment(PSNR_data, noise_name)
+    plot_experiment(load_results(f'./results/{noise_name}/results.npz'), noise_name)
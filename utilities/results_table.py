@@ -0,0 +1,176 @@
+'''Append-only, columnar table of experiment results.
+
+Every row is one (image, noise, param, algo, dtype) cell. The table is stored as an .npz
+file holding one array per column, and is loaded as a NumPy structured array, so that
+aggregating hundreds of cells is a handful of vectorized operations. New rows are appended
+as fixed-size records to a .rows file next to it, so an append only writes its own rows,
+and consolidate_results folds them into the .npz.
+'''
+
+import os
+
+import numpy as np
+from numpy.lib import recfunctions
+
+
+RESULT_DTYPE = np.dtype([
+    ('image', 'U32'),
+    ('noise', 'U16'),
+    ('param', 'f8'),
+    ('algo', 'U16'),
+    ('dtype', 'U16'),
+    ('PSNR', 'f8'),
+    ('SSIM', 'f8'),
+    ('seconds', 'f8'),
+    ('peak_memory', 'i8'),
+    ('iterations', 'i8'),
+])
+CELL_FIELDS = ['image', 'noise', 'param', 'algo', 'dtype']
+
+
+def make_rows(rows):
+    '''Builds table rows.
+
+    Args:
+        rows (list): The rows, as tuples in the order of RESULT_DTYPE or as dicts keyed by column.
+
+    Returns:
+        table (np.ndarray): The rows as a structured array.
+    '''
+    return np.array([tuple(row[name] for name in RESULT_DTYPE.names) if isinstance(row, dict) else tuple(row)
+                     for row in rows], dtype=RESULT_DTYPE)
+
+
+def load_results(path, latest=True):
+    '''Loads a results table, including the rows appended since it was last consolidated.
+
+    Args:
+        path (str): The .npz file of the table.
+        latest (bool): Whether to only keep the last row appended for each cell, dropping
+            the results of earlier runs.
+
+    Returns:
+        table (np.ndarray): The rows as a structured array, empty if there is no table.
+    '''
+    table = np.empty(0, dtype=RESULT_DTYPE)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            table = np.zeros(len(data[RESULT_DTYPE.names[0]]), dtype=RESULT_DTYPE)
+            for name in RESULT_DTYPE.names:
+                # Columns added after the table was written are left empty (NaN for floats, '' for strings)
+                if name in data:
+                    table[name] = data[name]
+                elif table.dtype[name].kind == 'f':
+                    table[name] = np.nan
+
+    if os.path.exists(_rows_path(path)):
+        with open(_rows_path(path), 'rb') as f:
+            records = f.read()
+        # A row cut short by an interrupted append is dropped
+        records = records[:len(records) - len(records) % RESULT_DTYPE.itemsize]
+        table = np.concatenate([table, np.frombuffer(records, dtype=RESULT_DTYPE)])
+
+    if latest and len(table) > 0:
+        _, last = np.unique(_cells(table[::-1]), return_index=True)
+        table = table[np.sort(len(table) - 1 - last)]
+    return table
+
+
+def append_results(path, rows):
+    '''Appends rows to a results table, creating it if needed.
+
+    The rows are added to the end of the table's .rows file, so the cost of an append does
+    not grow with the table.
+
+    Args:
+        path (str): The .npz file of the table.
+        rows (np.ndarray): The structured rows to append (see make_rows).
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(_rows_path(path), 'ab') as f:
+        f.write(np.asarray(rows, dtype=RESULT_DTYPE).tobytes())
+
+
+def consolidate_results(path):
+    '''Folds the appended rows of a results table into its .npz file.
+
+    The file is rewritten next to the old one and then swapped in, so an interruption
+    never loses the rows already stored.
+
+    Args:
+        path (str): The .npz file of the table.
+    '''
+    if not os.path.exists(_rows_path(path)):
+        return
+
+    table = load_results(path, latest=False)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **{name: table[name] for name in RESULT_DTYPE.names})
+    os.replace(tmp_path, path)
+    os.remove(_rows_path(path))
+
+
+def rows_from_pickles(psnr_results, time_results, noise_type, hyperparameters):
+    '''Converts the nested-dict results of the original experiments into table rows.
+
+    Args:
+        psnr_results (dict): The PSNRs, keyed by algo and then image, one per hyperparameter.
+        time_results (dict): The seconds, in the same layout.
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        hyperparameters (list): The hyperparameters, in the order of the lists.
+
+    Returns:
+        table (np.ndarray): The rows, in float64 and with the columns the pickles lack left
+            empty (NaN SSIM, no peak memory or iterations).
+    '''
+    return make_rows([(im_name, noise_type, param, algo, 'float64', psnr, np.nan, seconds, 0, 0)
+                      for algo, images in psnr_results.items()
+                      for im_name, psnrs in images.items()
+                      for param, psnr, seconds in zip(hyperparameters, psnrs, time_results[algo][im_name])])
+
+
+def group_by(table, keys, column):
+    '''Aggregates a column over the rows that share the same keys.
+
+    Args:
+        table (np.ndarray): The structured rows.
+        keys (list): The columns to group by, e.g. ['param', 'algo'].
+        column (str): The column to aggregate, e.g. 'PSNR'.
+
+    Returns:
+        groups (np.ndarray): The sorted, unique keys, as a structured array.
+        mean (np.ndarray): The mean of the column in each group.
+        std (np.ndarray): The standard deviation of the column in each group.
+    '''
+    groups, inverse = np.unique(recfunctions.repack_fields(table[keys]), return_inverse=True)
+    inverse = inverse.ravel()
+    sizes = np.bincount(inverse, minlength=len(groups))
+    values = table[column].astype(np.float64)
+    mean = np.bincount(inverse, values, minlength=len(groups)) / sizes
+    std = np.sqrt(np.bincount(inverse, np.square(values - mean[inverse]), minlength=len(groups)) / sizes)
+    return groups, mean, std
+
+
+def _cells(table):
+    '''Selects the columns identifying the cell of each row.
+
+    Args:
+        table (np.ndarray): The structured rows.
+
+    Returns:
+        cells (np.ndarray): The (image, noise, param, algo, dtype) of each row.
+    '''
+    return recfunctions.repack_fields(table[CELL_FIELDS])
+
+
+def _rows_path(path):
+    '''Names the file the rows of a table are appended to.
+
+    Args:
+        path (str): The .npz file of the table.
+
+    Returns:
+        rows_path (str): The .rows file next to it.
+    '''
+    return f'{os.path.splitext(path)[0]}.rows'
@@ -0,0 +1,341 @@
+'''Parallel experiment runner with a resumable on-disk result cache. '''
+
+import os
+import time
+import hashlib
+import tracemalloc
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from filters.instrumentation import Instrumentation, count
+from utilities.metrics import quality_metrics
+from utilities.utils import read_image, update_image_store, add_gaussian_noise, add_poisson_noise, normalize_image
+from utilities.results_table import append_results, consolidate_results, load_results, make_rows
+
+
+# Workers never show figures, and already run in parallel, so BLAS and OpenMP get one thread each
+WORKER_ENVIRONMENT = {'MPLBACKEND': 'Agg', 'OMP_NUM_THREADS': '1', 'OPENBLAS_NUM_THREADS': '1', 'MKL_NUM_THREADS': '1'}
+ALGORITHMS = ['quad', 'TV', 'nlm', 'wnnm']
+ALGORITHM_SETTINGS = {
+    'quad': {'lamb': 5},
+    'TV': {'lamb': 6},
+    'nlm': {'patch_size': 7, 'search_dist': 10, 'h': 0.1},
+    'wnnm': {'patch_size': 7, 'search_dist': 10, 'delta': 0.3, 'iterations': 1},
+}
+CACHE_VERSION = 4
+
+
+def make_noisy_image(im, im_name, noise_type, param, dtype=np.float64):
+    '''Corrupts an image with noise, seeding the generator from the cell so that every
+       algorithm (and every rerun) sees the same noisy image.
+
+    Args:
+        im (np.ndarray): The original image.
+        im_name (str): The name of the image (e.g. clock).
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        param (float): The noise variance ('gaussian') or number of photons ('poisson').
+        dtype (np.dtype): The floating point type of the noisy image.
+
+    Returns:
+        noisy_im (np.ndarray): The noisy image.
+        variance (float): The (approximate) variance of the noise.
+    '''
+    seed = int.from_bytes(hashlib.sha256(f'{im_name}/{noise_type}/{param}'.encode()).digest()[:4], 'little')
+    np.random.seed(seed)
+    if noise_type == 'gaussian':
+        noisy_im = add_gaussian_noise(im, mean=0, var=param, dtype=dtype)
+        variance = param
+    elif noise_type == 'poisson':
+        noisy_im = add_poisson_noise(im, photons=param, dtype=dtype)
+        variance = 0.5/param
+    else:
+        raise ValueError(f'Unknown noise type: {noise_type}')
+    return noisy_im, variance
+
+
+def get_filter(algo):
+    '''Imports the filter of an algorithm. Filters are only imported by the processes that
+       run them, which keeps the startup of short jobs and of worker processes fast.
+
+    Args:
+        algo (str): The algorithm, one of ALGORITHMS.
+
+    Returns:
+        filter_fn (callable): The filter.
+    '''
+    if algo == 'quad':
+        from filters.quadratic_filter import quadratic_filter
+        return quadratic_filter
+    elif algo == 'TV':
+        from filters.TV_filter_pd import TV_filter_pd
+        return TV_filter_pd
+    elif algo == 'nlm':
+        from filters.non_local_means_filter import non_local_means_filter
+        return non_local_means_filter
+    elif algo == 'wnnm':
+        from filters.non_local_wnnm_filter import non_local_wnnm_filter
+        return non_local_wnnm_filter
+    raise ValueError(f'Unknown algorithm: {algo}')
+
+
+def denoise(algo, noisy_im, variance, dtype=np.float64, instrument=None):
+    '''Runs one of the filters with the experiment settings and normalizes the result.
+
+    Args:
+        algo (str): The algorithm, one of ALGORITHMS.
+        noisy_im (np.ndarray): The noisy image.
+        variance (float): The variance of the noise on the image.
+        dtype (np.dtype): The floating point type the filters compute in.
+        instrument (Instrumentation): If given, collects the counters of the filter, including
+            its number of iterations.
+
+    Returns:
+        clean_im (np.ndarray): The normalized, filtered image.
+    '''
+    settings = ALGORITHM_SETTINGS[algo]
+    filter_fn = get_filter(algo)
+    if algo == 'quad':
+        clean_im = filter_fn(noisy_im, settings['lamb'], dtype=dtype, instrument=instrument)
+    elif algo == 'TV':
+        clean_im = filter_fn(noisy_im, settings['lamb'], dtype=dtype, instrument=instrument)
+    elif algo == 'nlm':
+        clean_im = filter_fn(noisy_im, settings['patch_size'], settings['search_dist'], settings['h'], dtype=dtype, instrument=instrument)
+    elif algo == 'wnnm':
+        x = noisy_im
+        y = noisy_im
+        for _ in range(settings['iterations']):
+            y = x + settings['delta']*(noisy_im - y)
+            x = filter_fn(y, settings['patch_size'], settings['search_dist'], variance, dtype=dtype, instrument=instrument)
+            count(instrument, 'iterations')
+            x = normalize_image(x)
+        clean_im = x
+    return normalize_image(clean_im)
+
+
+def cell_key(im, im_name, noise_type, param, algo, dtype=np.float64):
+    '''Hashes everything that determines the result of a cell.
+
+    Args:
+        im (np.ndarray): The original image.
+        im_name (str): The name of the image (e.g. clock).
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        param (float): The noise hyperparameter.
+        algo (str): The algorithm, one of ALGORITHMS.
+        dtype (np.dtype): The floating point type of the computation.
+
+    Returns:
+        key (str): The hex digest identifying the cell.
+    '''
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(im).tobytes())
+    h.update(repr((CACHE_VERSION, im.shape, im_name, noise_type, param, algo, np.dtype(dtype).name, sorted(ALGORITHM_SETTINGS[algo].items()))).encode())
+    return h.hexdigest()
+
+
+def run_cell(im, im_name, noise_type, param, algo, cache_path, dtype=np.float64):
+    '''Runs a single (image, noise, param, algo) cell and stores it in the cache.
+
+    Args:
+        im (np.ndarray): The original image.
+        im_name (str): The name of the image (e.g. clock).
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        param (float): The noise hyperparameter.
+        algo (str): The algorithm, one of ALGORITHMS.
+        cache_path (str): The file the result is written to.
+        dtype (np.dtype): The floating point type of the computation.
+
+    Returns:
+        result (dict): The PSNR, SSIM, runtime in seconds, peak memory in bytes, number of iterations
+            and cleaned image of the cell.
+    '''
+    noisy_im, variance = make_noisy_image(im, im_name, noise_type, param, dtype)
+    instrument = Instrumentation()
+
+    # Import the filter up front, so that the import counts towards neither the time nor the memory
+    get_filter(algo)
+
+    # The timed run is never traced. Its peak memory is read from the peak resident set size
+    # where the OS lets it be reset, and measured in a separate, traced run otherwise
+    start_rss = _reset_peak_rss()
+    start_time = time.time()
+    clean_im = denoise(algo, noisy_im, variance, dtype, instrument)
+    seconds = time.time() - start_time
+    if start_rss is not None:
+        peak_memory = _read_rss('VmHWM') - start_rss
+    else:
+        peak_memory = _traced_peak_memory(algo, noisy_im, variance, dtype)
+
+    metrics = quality_metrics(im, clean_im)
+    result = {'PSNR': float(metrics['PSNR']), 'SSIM': float(metrics['SSIM']), 'seconds': seconds, 'peak_memory': peak_memory,
+              'iterations': instrument.counters['iterations'], 'clean_im': clean_im}
+
+    # Write to a temporary file first so an interrupted run never leaves a partial entry
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **result)
+    os.replace(tmp_path, cache_path)
+    return result
+
+
+def load_cell(cache_path):
+    '''Loads a cell from the cache.
+
+    Args:
+        cache_path (str): The cache file of the cell.
+
+    Returns:
+        result (dict): The PSNR, SSIM, runtime in seconds, peak memory in bytes, number of iterations
+            and cleaned image of the cell.
+    '''
+    with np.load(cache_path) as data:
+        return {'PSNR': float(data['PSNR']), 'SSIM': float(data['SSIM']), 'seconds': float(data['seconds']), 'peak_memory': int(data['peak_memory']),
+                'iterations': int(data['iterations']), 'clean_im': data['clean_im']}
+
+
+def run_experiment(images, noise_type, hyperparameters, algos=ALGORITHMS, cache_dir=None, max_workers=None, dtype=np.float64, on_result=None,
+                   table_path=None):
+    '''Runs every (image, noise, param, algo) cell on a pool of processes, skipping the
+       cells that are already in the cache. Every new cell is appended to the results table
+       as soon as it finishes, and the table is consolidated once all of them have.
+
+    Args:
+        images (list): The list of image names, e.g. 'clock'.
+        noise_type (str): The type of noise, either 'gaussian' or 'poisson'.
+        hyperparameters (list): The list of hyperparameters for that noise being tested.
+        algos (list): The algorithms to run.
+        cache_dir (str): The directory of the result cache. Defaults to ./results/<noise_type>/cache.
+        max_workers (int): The maximum number of processes. If None, uses every CPU. The workers
+            are started fresh in the WORKER_ENVIRONMENT, so each one runs BLAS on a single thread
+            and they do not oversubscribe the CPUs.
+        dtype (np.dtype): The floating point type of the whole pipeline, from the noise to the filters.
+        on_result (callable): If given, called with the (im_name, param, algo) key and the result
+            of every cell as soon as it is available, e.g. to save it while the others run.
+        table_path (str): The results table (see utilities.results_table). Defaults to
+            ./results/<noise_type>/results.npz.
+
+    Returns:
+        results (dict): The result of each cell, keyed by (im_name, param, algo).
+    '''
+    if cache_dir is None:
+        cache_dir = f'./results/{noise_type}/cache'
+    if table_path is None:
+        table_path = f'./results/{noise_type}/results.npz'
+    os.makedirs(cache_dir, exist_ok=True)
+    update_image_store(images)
+
+    # Cached cells are only added to the table if it lost them, e.g. because it was deleted
+    table = load_results(table_path)
+    table = table[(table['noise'] == noise_type) & (table['dtype'] == np.dtype(dtype).name)]
+    tabled = set(zip(table['image'].tolist(), table['param'].tolist(), table['algo'].tolist()))
+
+    def store(key, result, fresh):
+        results[key] = result
+        if fresh or key not in tabled:
+            im_name, param, algo = key
+            append_results(table_path, make_rows([(im_name, noise_type, param, algo, np.dtype(dtype).name, result['PSNR'],
+                                                   result['SSIM'], result['seconds'], result['peak_memory'],
+                                                   result['iterations'])]))
+        if on_result is not None:
+            on_result(key, result)
+
+    results = {}
+    pending = []
+    for im_name in images:
+        im = read_image(im_name, dtype=dtype)
+        for param in hyperparameters:
+            for algo in algos:
+                cache_path = os.path.join(cache_dir, f'{cell_key(im, im_name, noise_type, param, algo, dtype)}.npz')
+                if os.path.exists(cache_path):
+                    store((im_name, param, algo), load_cell(cache_path), fresh=False)
+                else:
+                    pending.append((im, im_name, noise_type, param, algo, cache_path, dtype))
+
+    if max_workers == 1:
+        for cell in pending:
+            store((cell[1], cell[3], cell[4]), run_cell(*cell), fresh=True)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            # Spawned workers start on submission, and only read the environment as they start
+            with _worker_environment():
+                futures = {executor.submit(run_cell, *cell): cell for cell in pending}
+            for future in as_completed(futures):
+                cell = futures[future]
+                store((cell[1], cell[3], cell[4]), future.result(), fresh=True)
+
+    consolidate_results(table_path)
+    return results
+
+
+@contextmanager
+def _worker_environment():
+    '''Sets the WORKER_ENVIRONMENT for the processes started inside the context, and restores
+       the previous environment afterwards. A forked worker would inherit the BLAS numpy has
+       already loaded with its thread count, so the workers must be spawned for it to apply.
+    '''
+    previous = {variable: os.environ.get(variable) for variable in WORKER_ENVIRONMENT}
+    os.environ.update(WORKER_ENVIRONMENT)
+    try:
+        yield
+    finally:
+        for variable, value in previous.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def _read_rss(field):
+    '''Reads a memory field of the current process from /proc.
+
+    Args:
+        field (str): The field, e.g. 'VmRSS' (resident set size) or 'VmHWM' (its peak).
+
+    Returns:
+        size (int): The size in bytes.
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) * 1024
+    raise OSError(f'{field} is not reported by /proc/self/status')
+
+
+def _reset_peak_rss():
+    '''Resets the peak resident set size of the current process (Linux only).
+
+    Returns:
+        rss (int): The resident set size in bytes after the reset, or None if it cannot be reset.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _read_rss('VmRSS')
+    except OSError:
+        return None
+
+
+def _traced_peak_memory(algo, noisy_im, variance, dtype):
+    '''Measures the peak memory of a filter by tracing the allocations of a separate run.
+
+    Args:
+        algo (str): The algorithm, one of ALGORITHMS.
+        noisy_im (np.ndarray): The noisy image.
+        variance (float): The variance of the noise on the image.
+        dtype (np.dtype): The floating point type the filters compute in.
+
+    Returns:
+        peak_memory (int): The peak memory allocated by the filter, in bytes.
+    '''
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    denoise(algo, noisy_im, variance, dtype)
+    peak_memory = tracemalloc.get_traced_memory()[1] - start_memory
+    if not tracing:
+        tracemalloc.stop()
+    return peak_memory
@@ -6,65 +6,109 @@ from math import log10, sqrt
 import numpy as np
 from PIL import Image
 
+from utilities.image_store import load_from_store, source_signature, store_key, stored_entries, write_store
 
-def read_image(filename):
-    '''Reads one of the images, resizes them, and normalizes them to have pixels between 0 and 1.
+
+def read_image(filename, size=(256, 256), use_store=True, dtype=np.float64):
+    '''Reads one of the images, optionally resizes it, and normalizes it to have pixels between 0 and 1.
+
+    Images are loaded from the preprocessed image store when it holds an up-to-date copy,
+    as a zero-copy view for float64, and are decoded from the PNG otherwise. The store
+    holds exactly the decoded float64 pixels, so both give the same image.
 
     Args:
         filename (str): The name of the image to be read (e.g. clock).
+        size (tuple): The (width, height) to resize the image to. If None, the image
+            keeps its native resolution and aspect ratio.
+        use_store (bool): Whether to look the image up in the image store first.
+        dtype (np.dtype): The floating point type of the image.
 
     Returns:
         im (np.ndarray): The normalized, resized image.
     '''
-    im = Image.open(f'./images/{filename}.png')
-    im = im.resize((256, 256))
+    path = f'./images/{filename}.png'
+    if use_store:
+        im = load_from_store(store_key(filename, size), source_signature(path))
+        if im is not None:
+            return im.astype(dtype, copy=False)
+
+    im = Image.open(path)
+    if size is not None:
+        im = im.resize(size)
     im = np.array(im)
-    im = normalize_image(im)
+    im = normalize_image(im).astype(dtype)
     return im
 
 
-def add_gaussian_noise(im, mean=0, var=0.01):
+def update_image_store(filenames, size=(256, 256)):
+    '''Adds the images that are missing or stale to the image store, keeping the rest.
+
+    Args:
+        filenames (list): The names of the images (e.g. clock).
+        size (tuple): The (width, height) the images are resized to, or None for the native resolution.
+    '''
+    entries = stored_entries()
+    updated = False
+    for filename in filenames:
+        key = store_key(filename, size)
+        signature = source_signature(f'./images/{filename}.png')
+        if key not in entries or entries[key][0] != signature:
+            entries[key] = (signature, read_image(filename, size, use_store=False))
+            updated = True
+
+    if updated:
+        write_store(entries)
+
+
+def add_gaussian_noise(im, mean=0, var=0.01, dtype=np.float64):
     '''Adds Gaussian noise to an image with the given variance.
 
     Args:
         mean (float): The mean of the Gaussian noise that is added.
         var (float): The variance of the Gaussian noise that is added.
+        dtype (np.dtype): The floating point type of the noisy image.
 
     Returns:
         noisy_im (np.ndarray): The noisy image.
     '''
     sigma = var**0.5
-    gaussian_noise = np.random.normal(mean, sigma, im.shape)
-    noisy_im = im + gaussian_noise
+    gaussian_noise = np.random.normal(mean, sigma, im.shape).astype(dtype, copy=False)
+    noisy_im = np.asarray(im, dtype=dtype) + gaussian_noise
     noisy_im = normalize_image(noisy_im)
     return noisy_im
 
 
-def add_poisson_noise(im, photons=100):
+def add_poisson_noise(im, photons=100, dtype=np.float64):
     '''Adds Poisson noise to an image with the given variance.
 
     Args:
         photons (float): The number of photons available per pixel.
+        dtype (np.dtype): The floating point type of the noisy image.
 
     Returns:
         noisy_im (np.ndarray): The noisy image.
     '''
-    noisy_im = np.random.poisson(im * photons) / photons
+    noisy_im = np.random.poisson(im * photons).astype(dtype) / photons
     noisy_im = normalize_image(noisy_im)
     return noisy_im
 
 
-def normalize_image(im):
+def normalize_image(im, dtype=None):
     '''Normalizes an image to have pixels only from 0-1
 
     Args:
-        im (np.ndarray): The image to be normalized.
+        im (np.ndarray): The image to be normalized, or a (B, n, m) stack of images,
+            each of which is normalized separately.
+        dtype (np.dtype): The floating point type of the result. Defaults to that of the
+            image (float64 for integer images).
 
     Returns:
         normalized_im (np.ndarray): The normalized image.
     '''
-    max_pixel = np.max(im)
-    min_pixel = np.min(im)
+    if dtype is not None:
+        im = np.asarray(im, dtype=dtype)
+    max_pixel = np.max(im, axis=(-2, -1), keepdims=True)
+    min_pixel = np.min(im, axis=(-2, -1), keepdims=True)
     normalized_im = (im - min_pixel) / max_pixel
     return normalized_im
 